@@ -0,0 +1,174 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# Description: benchmark metricsRestZFSSA.py against the local mock appliance
+# (mockZFSSA.py). Every run starts the sensor script the way PRTG does, as a
+# new interpreter, and reports the run time, the peak RSS of the sensor
+# process, the requests the appliance got and when each dataset was answered.
+# Usage:
+# benchZFSSA.py
+# benchZFSSA.py --runs 10 --latency 200 --jitter 300 --params "--workers 8"
+# benchZFSSA.py --missing fc.ops,smb.ops,ftp.kilobytes --error-rate 0.05
+# benchZFSSA.py --breakdown 5000 --scenario "top=--include cpu,nfs3client --top 10"
+# benchZFSSA.py --extra nfs4.ops[client],io.kilobytes --scenario discover=--discover
+# benchZFSSA.py --cluster --latency 2000 --jitter 1000
+# benchZFSSA.py --shares 20000 --runs 2 --scenario "capacity=--include capacity"
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import statistics
+import subprocess
+from collections import OrderedDict, defaultdict
+
+import mockZFSSA
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir,
+                      "metricsRestZFSSA.py")
+
+# name and sensor parameters of the default scenarios
+SCENARIOS = OrderedDict([
+    ("all", ""),
+    ("include", "--include cpu,disk,nfs3,iscsi"),
+    ("exclude", "--exclude nfs2,smb,fc"),
+])
+
+
+def run_sensor(script, params, timeout):
+    """Run the sensor once, return wall seconds, peak RSS in KB and output"""
+    argv = json.dumps({"params": params, "timeout": timeout})
+    with tempfile.TemporaryFile() as errors:
+        started = time.time()
+        proc = subprocess.Popen([sys.executable, script, argv],
+                                stdout=subprocess.PIPE, stderr=errors)
+        output = proc.stdout.read()
+        proc.stdout.close()
+        _, status, usage = os.wait4(proc.pid, 0)
+        wall = time.time() - started
+        proc.returncode = status
+        if status != 0:
+            errors.seek(0)
+            sys.stderr.write(errors.read().decode("utf-8", "replace"))
+    return wall, usage.ru_maxrss, output.decode("utf-8", "replace")
+
+
+def summary(output):
+    """Return channels count and error text of a sensor output"""
+    try:
+        prtg = json.loads(output)["prtg"]
+    except ValueError:
+        return 0, "invalid output"
+    if prtg.get("error"):
+        return 0, prtg.get("text")
+    text = prtg.get("text")
+    return len(prtg.get("result", [])), None if text == "OK" else text
+
+
+def bench(state, host, name, params, args, peer=None):
+    """Run a scenario args.runs times and print its results. peer is the
+    state of the other cluster head, if there is one."""
+    cachedir = tempfile.mkdtemp()
+    params = ("--host {} --username bench --password bench "
+              "--cachedir {} {} {}").format(host, cachedir, params,
+                                            args.params)
+    walls, rss, requests, channels = [], [], [], []
+    failures = set()
+    latency = defaultdict(list)
+    answered = defaultdict(list)
+    heads = [state] if peer is None else [state, peer]
+    for _ in range(args.runs):
+        for head in heads:
+            head.reset()
+        wall, maxrss, output = run_sensor(args.script, params, args.timeout)
+        count, error = summary(output)
+        walls.append(wall)
+        rss.append(maxrss)
+        requests.append(sum(sum(h.requests.values()) for h in heads))
+        channels.append(count)
+        if error:
+            failures.add(error)
+        for head, prefix in zip(heads, ("", "peer ")):
+            for dataset, arrived, done, _ in head.served:
+                latency[prefix + dataset].append(done - arrived)
+                answered[prefix + dataset].append(done)
+    shutil.rmtree(cachedir)
+    print("\n{}: {}".format(name, params))
+    print("  run time   median {:.3f}s  max {:.3f}s".format(
+        statistics.median(walls), max(walls)))
+    print("  peak RSS   {:.1f} MB".format(max(rss) / 1024.0))
+    print("  requests   {:.1f} per run".format(statistics.mean(requests)))
+    print("  channels   {:.1f} per run".format(statistics.mean(channels)))
+    for failure in sorted(failures):
+        print("  message    {}".format(failure))
+    print("  {:<28} {:>8} {:>12} {:>12}".format(
+        "dataset", "requests", "latency ms", "answered ms"))
+    for dataset in sorted(latency, key=lambda d: statistics.mean(answered[d])):
+        print("  {:<28} {:>8} {:>12.1f} {:>12.1f}".format(
+            dataset, len(latency[dataset]),
+            statistics.mean(latency[dataset]) * 1000,
+            statistics.mean(answered[dataset]) * 1000))
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description="Benchmark metricsRestZFSSA.py against a mock appliance")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--timeout", type=int, default=60,
+                        help="PRTG timeout given to the sensor")
+    parser.add_argument("--params", default="",
+                        help="sensor parameters added to every scenario")
+    parser.add_argument("--scenario", action="append", default=[],
+                        metavar="NAME=PARAMS",
+                        help="run this scenario instead of the default ones")
+    parser.add_argument("--script", default=SCRIPT)
+    parser.add_argument("--latency", type=float, default=0,
+                        help="milliseconds added to every answer")
+    parser.add_argument("--jitter", type=float, default=0,
+                        help="random milliseconds added to the latency")
+    parser.add_argument("--error-rate", type=float, default=0,
+                        help="fraction of dataset requests answered 500")
+    parser.add_argument("--missing", default="",
+                        help="comma separated datasets answered 404")
+    parser.add_argument("--breakdown", type=int, default=100,
+                        help="keys in breakdown datasets")
+    parser.add_argument("--cluster", action="store_true",
+                        help="add a peer head answering without latency or "
+                             "errors, the sensor hedges requests to it")
+    parser.add_argument("--suspended", default="",
+                        help="comma separated datasets listed as suspended")
+    parser.add_argument("--extra", default="",
+                        help="comma separated datasets listed besides the "
+                             "usual ones")
+    parser.add_argument("--shares", type=int, default=200,
+                        help="shares in the storage pools")
+    parser.add_argument("--pools", type=int, default=2,
+                        help="storage pools")
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args(sys.argv[1:])
+    scenarios = SCENARIOS
+    if args.scenario:
+        scenarios = OrderedDict(s.split("=", 1) for s in args.scenario)
+    state = mockZFSSA.state_from_args(args)
+    server = mockZFSSA.start(state)
+    host = "127.0.0.1:{}".format(server.server_address[1])
+    peer = peerserver = None
+    if args.cluster:
+        peer = mockZFSSA.MockState(breakdown=args.breakdown,
+                                   shares=args.shares, pools=args.pools)
+        peerserver = mockZFSSA.start(peer)
+        host += "+127.0.0.1:{}".format(peerserver.server_address[1])
+    for name, params in scenarios.items():
+        bench(state, host, name, params, args, peer)
+    server.shutdown()
+    if peerserver is not None:
+        peerserver.shutdown()
+
+
+if __name__ == "__main__":
+    main()
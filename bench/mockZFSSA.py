@@ -0,0 +1,347 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# Description: local stand-in for the ZFSSA REST service, to benchmark
+# metricsRestZFSSA.py without an appliance. It answers logins and the
+# analytics datasets list and data requests over HTTPS with a self signed
+# certificate (made with the openssl command unless --cert and --key are
+# given).
+# Usage:
+# mockZFSSA.py --port 8215
+# mockZFSSA.py --port 8215 --latency 200 --jitter 100 --missing fc.ops,smb.ops
+# mockZFSSA.py --port 8215 --error-rate 0.1 --breakdown 5000
+# mockZFSSA.py --port 8215 --suspended smb.ops --extra nfs4.ops[client]
+# mockZFSSA.py --port 8215 --shares 5000 --pools 2
+# Then point the sensor to it with --host 127.0.0.1:8215
+
+import os
+import re
+import ssl
+import sys
+import gzip
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlsplit, parse_qs, unquote
+
+DATAPATH = re.compile(r"^/api/analytics/v1/datasets/([^/]+)/data$")
+LISTPATH = "/api/analytics/v1/datasets"
+STORAGEPATH = "/api/storage/v1/pools"
+ACCESSPATH = "/api/access/v1"
+# datasets listed by the appliance besides the extra ones
+DATASETS = ["cpu.utilization", "nfs2.ops", "nfs3.ops", "nfs4.ops", "io.ops",
+            "fc.ops", "iscsi.ops", "smb.ops", "smb2.ops", "smb3.ops",
+            "nic.kilobytes", "arc.hitratio", "http.reqs", "sftp.kilobytes",
+            "ftp.kilobytes", "nfs3.ops[client]", "io.ops[disk]",
+            "nfs3.ops[latency]", "iscsi.ops[latency]",
+            "arc.accesses[hit/miss]"]
+TOKEN = "mock-session-token"
+# shares in each project of the storage API, every LUNEVERY-th is a lun
+PROJECTSHARES = 50
+LUNEVERY = 10
+GIGABYTE = 1024 ** 3
+
+
+class MockState(object):
+    """Behaviour of the mock appliance and the requests it served"""
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, missing=(),
+                 breakdown=100, suspended=(), extra=(), shares=200, pools=2):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.missing = set(missing)
+        self.breakdown = breakdown
+        self.suspended = set(suspended)
+        self.extra = list(extra)
+        self.shares = shares
+        self.pools = pools
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Forget the requests served so far"""
+        with self.lock:
+            self.started = time.time()
+            self.requests = Counter()
+            self.served = []
+
+    def record(self, name, arrived, status):
+        """Count a request, and keep when it arrived and was answered"""
+        with self.lock:
+            self.requests[name] += 1
+            self.served.append((name, arrived - self.started,
+                                time.time() - self.started, status))
+
+
+# latency buckets of histogram datasets, in microseconds
+LATENCIES = [10 * 2 ** i for i in range(20)]
+
+
+def sample(name, breakdown):
+    """Return one second of data for dataset name"""
+    if name.endswith("[latency]"):
+        data = [{"key": str(latency),
+                 "value": random.randint(0, 4000) >> i}
+                for i, latency in enumerate(LATENCIES)]
+        return {"sample": 0, "data": {"value": sum(d["value"] for d in data),
+                                      "data": data}}
+    if "[" not in name:
+        return {"sample": 0, "data": {"value": random.randint(0, 1000)}}
+    keys = ["client{}".format(i) for i in range(breakdown)]
+    data = [{"key": key, "value": random.randint(0, 1000)} for key in keys]
+    return {"sample": 0, "data": {"value": sum(d["value"] for d in data),
+                                  "data": data}}
+
+
+def catalog(state):
+    """Return the datasets list, without the missing datasets"""
+    return {"datasets": [{"name": name, "suspended": name in state.suspended,
+                          "href": LISTPATH + "/" + name}
+                         for name in DATASETS + state.extra
+                         if name not in state.missing]}
+
+
+def projects(state, pool):
+    """Return the project names of a pool, and the share count of each"""
+    count = -(-state.shares // state.pools)
+    first = int(pool.split("-")[1]) * count
+    count = max(0, min(count, state.shares - first))
+    return [("project{}".format(first // PROJECTSHARES + i),
+             min(PROJECTSHARES, count - i * PROJECTSHARES))
+            for i in range(-(-count // PROJECTSHARES))]
+
+
+def share(pool, project, number):
+    """Return a share like the appliance lists them, with the properties it
+    has besides the ones the sensor uses, and its usage growing a little on
+    every request."""
+    name = "share{}".format(number)
+    kind = "lun" if number % LUNEVERY == 0 else "filesystem"
+    size = random.Random("{}/{}/{}".format(pool, project, name)).randint(
+        1, 100) * GIGABYTE
+    used = int(size * random.uniform(0.3, 1.0))
+    content = {"name": name, "pool": pool, "project": project,
+               "href": "{}/{}/projects/{}/{}s/{}".format(
+                   STORAGEPATH, pool, project, kind, name),
+               "space_total": used, "space_data": used,
+               "space_snapshots": 0, "canonical_name": "{}/local/{}/{}".format(
+                   pool, project, name)}
+    content.update(("property{}".format(i), "inherited") for i in range(40))
+    if kind == "lun":
+        content["volsize"] = size
+    else:
+        content.update(quota=size if number % 2 else 0,
+                       space_available=size - used)
+    return kind, content
+
+
+def storage(state, path):
+    """Return the status, content and request name of a storage API path"""
+    parts = path[len(STORAGEPATH):].strip("/").split("/")
+    pools = ["pool-{}".format(i) for i in range(state.pools)]
+    if parts == [""]:
+        return 200, {"pools": [{"name": p, "status": "online"}
+                               for p in pools]}, "pools"
+    if parts[0] not in pools:
+        return 404, {"fault": {"code": 404}}, "pool"
+    pool = parts[0]
+    if len(parts) == 1:
+        total = 1000 * state.shares * GIGABYTE
+        used = int(total * random.uniform(0.5, 0.9))
+        return 200, {"pool": {"name": pool, "usage": {
+            "used": used, "available": total - used}}}, "pool"
+    counts = dict(projects(state, pool))
+    if len(parts) == 2:
+        return 200, {"projects": [{"name": p, "pool": pool}
+                                  for p in counts]}, "projects"
+    project = parts[2]
+    if project not in counts or len(parts) < 4:
+        return 404, {"fault": {"code": 404}}, "project"
+    first = int(project[len("project"):]) * PROJECTSHARES
+    kind = parts[3][:-1]
+    if len(parts) == 4:
+        listed = [share(pool, project, n)
+                  for n in range(first, first + counts[project])]
+        return 200, {parts[3]: [c for k, c in listed if k == kind]}, parts[3]
+    number = int(parts[4][len("share"):])
+    found, content = share(pool, project, number)
+    if found != kind or not first <= number < first + counts[project]:
+        return 404, {"fault": {"code": 404}}, kind
+    return 200, {kind: content}, kind
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    """Answer requests like the appliance REST service"""
+
+    protocol_version = "HTTP/1.1"
+    state = None
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, content, headers=None):
+        body = json.dumps(content).encode("utf-8")
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            body = gzip.compress(body)
+            headers = dict(headers or {}, **{"Content-Encoding": "gzip"})
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for header, value in (headers or {}).items():
+            self.send_header(header, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def authorized(self):
+        return (self.headers.get("X-Auth-Session") == TOKEN or
+                self.headers.get("Authorization", "").startswith("Basic "))
+
+    def do_POST(self):
+        arrived = time.time()
+        length = int(self.headers.get("Content-Length", 0))
+        self.rfile.read(length)
+        if urlsplit(self.path).path != ACCESSPATH or not self.authorized():
+            self.reply(401, {"fault": {"code": 401}})
+            self.state.record("login", arrived, 401)
+            return
+        self.reply(201, {"access": {}}, {"X-Auth-Session": TOKEN})
+        self.state.record("login", arrived, 201)
+
+    def do_GET(self):
+        arrived = time.time()
+        state = self.state
+        url = urlsplit(self.path)
+        match = DATAPATH.match(url.path)
+        name = unquote(match.group(1)) if match else url.path
+        if state.latency or state.jitter:
+            time.sleep(state.latency + random.uniform(0, state.jitter))
+        if url.path.startswith(STORAGEPATH) and self.authorized():
+            status, content, name = storage(state, url.path)
+        elif url.path == LISTPATH and self.authorized():
+            status = 200
+            content = catalog(state)
+        elif match is None or name in state.missing:
+            status = 404
+            content = {"fault": {"code": 404, "name": "ERR_NOT_FOUND"}}
+        elif not self.authorized():
+            status = 401
+            content = {"fault": {"code": 401}}
+        elif random.random() < state.error_rate:
+            status = 500
+            content = {"fault": {"code": 500}}
+        else:
+            status = 200
+            seconds = int(parse_qs(url.query).get("seconds", ["1"])[0])
+            if seconds > 1:
+                one = sample(name, state.breakdown)
+                content = {"data": [one] * seconds}
+            else:
+                content = {"data": sample(name, state.breakdown)}
+        self.reply(status, content)
+        state.record(name, arrived, status)
+
+
+class MockServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # sensors exit without waiting for answers they don't need anymore
+        pass
+
+
+def self_signed_cert(directory):
+    """Make a certificate and key for localhost with the openssl command"""
+    cert = os.path.join(directory, "mock.crt")
+    key = os.path.join(directory, "mock.key")
+    with open(os.devnull, "w") as devnull:
+        subprocess.check_call(["openssl", "req", "-x509", "-nodes",
+                               "-newkey", "rsa:2048", "-days", "1",
+                               "-subj", "/CN=localhost",
+                               "-keyout", key, "-out", cert],
+                              stdout=devnull, stderr=devnull)
+    return cert, key
+
+
+def start(state, port=0, cert=None, key=None):
+    """Serve state on 127.0.0.1:port in a background thread, port 0 picks a
+    free one. Return the server, its port is server.server_address[1]."""
+    certdir = None
+    if cert is None:
+        certdir = tempfile.mkdtemp()
+        cert, key = self_signed_cert(certdir)
+    handler = type("Handler", (MockHandler,), {"state": state})
+    server = MockServer(("127.0.0.1", port), handler)
+    context = ssl.SSLContext(getattr(ssl, "PROTOCOL_TLS_SERVER",
+                                     ssl.PROTOCOL_SSLv23))
+    context.load_cert_chain(cert, key)
+    # handshakes happen in the request threads, not in the accept loop
+    server.socket = context.wrap_socket(server.socket, server_side=True,
+                                        do_handshake_on_connect=False)
+    if certdir is not None:
+        shutil.rmtree(certdir)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description="Local stand-in for the ZFSSA REST service")
+    parser.add_argument("--port", type=int, default=8215)
+    parser.add_argument("--latency", type=float, default=0,
+                        help="milliseconds added to every answer")
+    parser.add_argument("--jitter", type=float, default=0,
+                        help="random milliseconds added to the latency")
+    parser.add_argument("--error-rate", type=float, default=0,
+                        help="fraction of dataset requests answered 500")
+    parser.add_argument("--missing", default="",
+                        help="comma separated datasets answered 404")
+    parser.add_argument("--breakdown", type=int, default=100,
+                        help="keys in breakdown datasets")
+    parser.add_argument("--suspended", default="",
+                        help="comma separated datasets listed as suspended")
+    parser.add_argument("--extra", default="",
+                        help="comma separated datasets listed besides the "
+                             "usual ones")
+    parser.add_argument("--shares", type=int, default=200,
+                        help="shares in the storage pools")
+    parser.add_argument("--pools", type=int, default=2,
+                        help="storage pools")
+    parser.add_argument("--cert")
+    parser.add_argument("--key")
+    return parser.parse_args(argv)
+
+
+def state_from_args(args):
+    return MockState(latency=args.latency / 1000.0,
+                     jitter=args.jitter / 1000.0,
+                     error_rate=args.error_rate,
+                     missing=[m for m in args.missing.split(",") if m],
+                     breakdown=args.breakdown,
+                     suspended=[s for s in args.suspended.split(",") if s],
+                     extra=[e for e in args.extra.split(",") if e],
+                     shares=args.shares, pools=args.pools)
+
+
+def main():
+    args = parse_args(sys.argv[1:])
+    server = start(state_from_args(args), args.port, args.cert, args.key)
+    print("mock ZFSSA on 127.0.0.1:{}".format(server.server_address[1]))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
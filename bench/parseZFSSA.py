@@ -0,0 +1,98 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# Description: measure the time and peak memory metricsRestZFSSA.py takes to
+# parse the response of each dataset, and the memory its result keeps,
+# compared with decoding the response to str and keeping the whole json
+# tree, the way json.loads(req.text) does it.
+# Responses are the ones the mock appliance (mockZFSSA.py) sends, with
+# --seconds samples as with the sensor --window option.
+# Usage:
+# parseZFSSA.py
+# parseZFSSA.py --breakdown 5000 --seconds 1,60 --runs 20
+
+import sys
+import json
+import time
+import argparse
+import statistics
+import tracemalloc
+
+import mockZFSSA
+from benchZFSSA import SCRIPT
+from resultZFSSA import load_sensor
+
+DATASETS = "cpu.utilization,nfs3.ops[client],io.ops[disk],nfs3.ops[latency]"
+
+
+def response(name, breakdown, seconds):
+    """Return the response bytes of the mock appliance for a dataset"""
+    if seconds > 1:
+        content = {"data": [mockZFSSA.sample(name, breakdown)] * seconds}
+    else:
+        content = {"data": mockZFSSA.sample(name, breakdown)}
+    return json.dumps(content).encode("utf-8")
+
+
+def text_parse(sensor, content, breakdown):
+    """Decode the response to str and keep the whole json tree"""
+    return json.loads(content.decode("utf-8"))
+
+
+def sensor_parse(sensor, content, breakdown):
+    """Parse the response bytes and keep the fields the channels use, as the
+    sensor does"""
+    return sensor.extract(sensor.json_loads(content), breakdown)
+
+
+def measure(parse, sensor, content, breakdown, runs):
+    """Return the median seconds of parse, its peak of allocated bytes and
+    the bytes its result keeps, traced in a run of its own so tracing
+    doesn't count in the time"""
+    times = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        parse(sensor, content, breakdown)
+        times.append(time.perf_counter() - started)
+    tracemalloc.start()
+    parsed = parse(sensor, content, breakdown)
+    kept, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del parsed
+    return statistics.median(times), peak, kept
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description="Measure parsing dataset responses")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--datasets", default=DATASETS,
+                        help="comma separated datasets")
+    parser.add_argument("--breakdown", type=int, default=1000,
+                        help="keys in breakdown datasets")
+    parser.add_argument("--seconds", default="1,60",
+                        help="comma separated samples per response")
+    parser.add_argument("--script", default=SCRIPT)
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args(sys.argv[1:])
+    sensor = load_sensor(args.script)
+    print("{:<20} {:>7} {:>9} {:<8} {:>10} {:>10} {:>10}".format(
+        "dataset", "seconds", "size KB", "parser", "parse ms", "peak KB",
+        "kept KB"))
+    for name in args.datasets.split(","):
+        for seconds in [int(s) for s in args.seconds.split(",")]:
+            content = response(name, args.breakdown, seconds)
+            for parser, parse in (("text", text_parse),
+                                  ("sensor", sensor_parse)):
+                median, peak, kept = measure(parse, sensor, content,
+                                             "[" in name, args.runs)
+                print("{:<20} {:>7} {:>9.1f} {:<8} {:>10.3f} {:>10.1f} "
+                      "{:>10.1f}".format(name, seconds, len(content) / 1024.0,
+                                         parser, median * 1000, peak / 1024.0,
+                                         kept / 1024.0))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# Description: measure the time metricsRestZFSSA.py takes to build and
+# serialize sensor results with many channels (breakdown metrics, several
+# appliances), compared with a dict per channel serialized with json.dumps,
+# the way paepy CustomSensorResult does it.
+# Usage:
+# resultZFSSA.py
+# resultZFSSA.py --channels 1000,5000 --runs 20
+
+import sys
+import json
+import time
+import argparse
+import statistics
+import importlib.util
+
+from benchZFSSA import SCRIPT
+
+# channel parameters of a breakdown metric
+KWARGS = {"is_float": False, "unit": "Custom", "limit_max_warning": 25000,
+          "limit_max_error": 50000, "is_limit_mode": 1,
+          "custom_unit": "Ops/sec"}
+
+
+def load_sensor(script):
+    """Import the sensor script as a module"""
+    spec = importlib.util.spec_from_file_location("metricsRestZFSSA", script)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def dict_result(count):
+    """Build and serialize count channels as dicts, return both times"""
+    started = time.perf_counter()
+    result = []
+    for i in range(count):
+        channel = {"name": "Disk client{}".format(i), "unit": "Custom",
+                   "value": i}
+        channel["LimitMode"] = 1
+        channel["LimitMaxError"] = KWARGS["limit_max_error"]
+        channel["LimitMaxWarning"] = KWARGS["limit_max_warning"]
+        channel["CustomUnit"] = KWARGS["custom_unit"]
+        result.append(channel)
+    built = time.perf_counter()
+    output = json.dumps({"prtg": {"result": result, "text": "OK"}})
+    return built - started, time.perf_counter() - built, output
+
+
+def sensor_result(sensor, count):
+    """Build and serialize count channels with the sensor result builder,
+    one add_channel call each with the parameters written out, as the checks
+    call it, return both times"""
+    started = time.perf_counter()
+    result = sensor.SensorResult()
+    for i in range(count):
+        result.add_channel(channel_name="Disk client{}".format(i), value=i,
+                           is_float=False, unit="Custom",
+                           limit_max_warning=25000, limit_max_error=50000,
+                           is_limit_mode=1, custom_unit="Ops/sec")
+    built = time.perf_counter()
+    output = result.get_json_result()
+    return built - started, time.perf_counter() - built, output
+
+
+def breakdown_result(sensor, count):
+    """Build and serialize count channels the way breakdown metrics add them,
+    in a single add_channels call, return both times"""
+    started = time.perf_counter()
+    result = sensor.SensorResult()
+    result.add_channels([("Disk client{}".format(i), i)
+                         for i in range(count)], **KWARGS)
+    built = time.perf_counter()
+    output = result.get_json_result()
+    return built - started, time.perf_counter() - built, output
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description="Measure building and serializing sensor results")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--channels", default="50,1000,5000",
+                        help="comma separated channel counts")
+    parser.add_argument("--script", default=SCRIPT)
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args(sys.argv[1:])
+    sensor = load_sensor(args.script)
+    print("{:>8} {:<16} {:>10} {:>12}".format("channels", "builder",
+                                              "build ms", "serialize ms"))
+    for count in [int(c) for c in args.channels.split(",")]:
+        for name, builder in (
+                ("dict per channel", dict_result),
+                ("add_channel", lambda n: sensor_result(sensor, n)),
+                ("add_channels", lambda n: breakdown_result(sensor, n))):
+            times = [builder(count) for _ in range(args.runs)]
+            if json.loads(times[-1][2])["prtg"]["result"][-1]["value"] != \
+                    count - 1:
+                sys.exit("{} result is wrong".format(name))
+            print("{:>8} {:<16} {:>10.3f} {:>12.3f}".format(
+                count, name,
+                statistics.median(t[0] for t in times) * 1000,
+                statistics.median(t[1] for t in times) * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# Description: measure the cold start of metricsRestZFSSA.py, the cost PRTG
+# pays on every scan of every sensor. For each run it records the time of an
+# empty interpreter, the sensor imports, the first byte received from the
+# mock appliance (mockZFSSA.py) and the whole sensor run, and the run time of
+# a --cached sensor, which doesn't contact the appliance.
+# Usage:
+# startupZFSSA.py
+# startupZFSSA.py --runs 20 --budget 300
+# startupZFSSA.py --importtime
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+import mockZFSSA
+from benchZFSSA import SCRIPT
+
+
+def run(argv):
+    """Run argv, return wall seconds and stderr"""
+    started = time.time()
+    proc = subprocess.Popen(argv, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+    _, errors = proc.communicate()
+    return time.time() - started, errors.decode("utf-8", "replace")
+
+
+def seed_result_cache(script, params, cachedir):
+    """Run the sensor daemon until it writes its first result"""
+    daemon = subprocess.Popen([sys.executable, script, "--daemon", "3600"] +
+                              params)
+    while not [f for f in os.listdir(cachedir) if f.endswith(".result")]:
+        if daemon.poll() is not None:
+            sys.exit("the sensor daemon stopped")
+        time.sleep(0.1)
+    daemon.terminate()
+    daemon.wait()
+
+
+def trace_times(trace):
+    """Return the imports and first byte seconds of the last run in trace"""
+    with open(trace) as lines:
+        records = [json.loads(line) for line in lines]
+    os.remove(trace)
+    first = [r["start"] + r["wait"] for r in records if "wait" in r]
+    imports = [r["imports"] for r in records if r["dataset"] == "run"]
+    return imports[-1], min(first) if first else float("nan")
+
+
+def importtime(script, argv):
+    """Print the modules taking the most time to import in the sensor"""
+    _, errors = run([sys.executable, "-X", "importtime", script, argv])
+    modules = {}
+    for line in errors.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            _, cumulative, name = line.split("|")
+            if cumulative.strip().isdigit():
+                name = name.strip()
+                modules[name] = max(modules.get(name, 0), int(cumulative))
+    print("\nslowest imports (cumulative ms)")
+    slowest = sorted(((c, n) for n, c in modules.items()), reverse=True)
+    for cumulative, name in slowest[:15]:
+        print("  {:>8.1f} {}".format(cumulative / 1000.0, name))
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description="Measure the cold start of metricsRestZFSSA.py")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--params", default="",
+                        help="sensor parameters added to every run")
+    parser.add_argument("--script", default=SCRIPT)
+    parser.add_argument("--budget", type=float, default=0,
+                        help="fail if the median sensor run takes longer "
+                             "than these milliseconds")
+    parser.add_argument("--importtime", action="store_true",
+                        help="list the slowest imports of the sensor")
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args(sys.argv[1:])
+    server = mockZFSSA.start(mockZFSSA.MockState())
+    cachedir = tempfile.mkdtemp()
+    trace = os.path.join(cachedir, "trace")
+    params = ("--host 127.0.0.1:{} --username bench --password bench "
+              "--cachedir {} {}").format(server.server_address[1], cachedir,
+                                         args.params)
+    live = json.dumps({"params": "{} --trace {}".format(params, trace),
+                       "timeout": 60})
+    cached = json.dumps({"params": "{} --cached 3600".format(params),
+                         "timeout": 60})
+    # session token and result caches for the runs below
+    run([sys.executable, args.script, live])
+    os.remove(trace)
+    seed_result_cache(args.script, params.split(), cachedir)
+    results = {"interpreter": [], "imports": [], "first byte": [],
+               "sensor": [], "cached sensor": []}
+    for _ in range(args.runs):
+        results["interpreter"].append(run([sys.executable, "-c", "pass"])[0])
+        wall, _ = run([sys.executable, args.script, live])
+        imports, first = trace_times(trace)
+        results["sensor"].append(wall)
+        results["imports"].append(imports)
+        results["first byte"].append(first)
+        results["cached sensor"].append(
+            run([sys.executable, args.script, cached])[0])
+    print("{:<16} {:>10} {:>10}".format("ms", "median", "max"))
+    for name in ("interpreter", "imports", "first byte", "sensor",
+                 "cached sensor"):
+        print("{:<16} {:>10.1f} {:>10.1f}".format(
+            name, statistics.median(results[name]) * 1000,
+            max(results[name]) * 1000))
+    print("(imports and first byte are counted from the sensor start)")
+    if args.importtime:
+        importtime(args.script, live)
+    server.shutdown()
+    shutil.rmtree(cachedir)
+    median = statistics.median(results["sensor"]) * 1000
+    if args.budget and median > args.budget:
+        print("sensor median {:.1f} ms is over the {:.1f} ms budget".format(
+            median, args.budget))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
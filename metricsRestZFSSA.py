@@ -9,59 +9,240 @@
 # --host <zfssa_ip> --username <username> --password <password>
 # --host <zfssa_ip> --username <username> --password <password> --include cpu,disk,nfs3
 # --host <zfssa_ip> --username <username> --password <password> --include smb2,nfs2,iscsi
+# --host <zfssa_ip> --username <username> --password <password> --workers 8
+# --host <zfssa_ip> --username <username> --password <password> --ratelimit 5 --burst 10
+# --host <zfssa_ip> --username <username> --password <password> --coalesce 5
+# --host <zfssa_ip> --username <username> --password <password> --dynamic
+# --host <zfssa_ip> --username <username> --password <password> --discover
+# --host <zfssa_ip> --username <username> --password <password> --refresh arc=5m,nic=300
+# --host <zfssa_ip> --username <username> --password <password> --selfmetrics --trace <trace_file>
+# --host <zfssa_ip> --username <username> --password <password> --include cpu,nfs3client --top 10
+# --host <zfssa_ip> --username <username> --password <password> --include nfs3,nfs3latency,iscsilatency
+# --host <zfssa_ip> --username <username> --password <password> --include capacity --capacity 90 --top 10
+# --host <zfssa_ip>,<zfssa_ip> --username <username> --password <password>
+# --host <head1_ip>+<head2_ip> --username <username> --password <password>
+# --inventory <inventory_file> --username <username> --password <password>
+# --host <zfssa_ip> --username <username> --password <password> --cached 180
+# --host <zfssa_ip> --username <username> --password <password> --prometheus <prom_file> --influx udp://<influx_ip>:8089
+# Daemon collecting for --cached sensors (run outside PRTG):
+# metricsRestZFSSA.py --host <zfssa_ip> --username <username> --password <password> --daemon 60
+# metricsRestZFSSA.py --host <zfssa_ip> --username <username> --password <password> --daemon 60 --listen 9215
+# Record the appliance responses of a run, and replay them without network
+# under the profiler (run outside PRTG):
+# metricsRestZFSSA.py --host <zfssa_ip> --username <username> --password <password> --record <record_file>
+# metricsRestZFSSA.py --host <zfssa_ip> --replay <record_file> --profile <stats_file>
+#
+# PRTG starts a new interpreter for every scan, so modules only some runs
+# need (requests, http.client and ssl, concurrent.futures, orjson...) are
+# imported where they are used, not here.
 
+import time
+# PRTG timeout is counted from the process start
+STARTED = time.time()
+import os
+import re
 import sys
 import json
 import getopt
-import requests
-# from requests.packages.urllib3.exceptions import InsecureRequestWarning  # for older requests
-from urllib3.exceptions import InsecureRequestWarning  # for newer requests
-from paepy.ChannelDefinition import CustomSensorResult
-
-# to disable warning
-# InsecureRequestWarning: Unverified HTTPS request is being made.
-# Adding certificate verification is strongly advised. See:
-# https://urllib3.readthedocs.io/en/latest/advanced-usage.html#ssl-warnings
-requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
+import heapq
+import zlib
+import binascii
+import threading
+from bisect import bisect_left
+from functools import partial
+from itertools import accumulate, chain
+from operator import itemgetter
+from collections import Counter, OrderedDict, deque, namedtuple
+IMPORTED = time.time()
 
 ###############################################################################
 # Holders for PRTG additional parameters
 ###############################################################################
-HOST = ""
+HOSTS = []
+INVENTORY = ""
 USERNAME = ""
 PASSWORD = ""
 EXCLUDECHECKS = []
 INCLUDECHECKS = []
+WORKERS = 4
+CACHEDIR = ""
+DAEMONINTERVAL = 0
+WINDOW = 1
+TOPK = 5
+SELFMETRICS = False
+TRACEFILE = ""
+CACHEDMAXAGE = 0
+USEREQUESTS = False
+DISCOVER = False
+# seconds between requests of a check's dataset, by check, 0 is every run,
+# and the --refresh items that are not <check>=<tier>
+REFRESH = {}
+BADREFRESH = []
+# requests per second and burst to an appliance from all the sensors of
+# this server, 0 is no limit
+RATELIMIT = 0
+RATEBURST = 0
+# seconds a dataset fetched by a sensor is used by the others asking for
+# it, 0 is every sensor fetching its own datasets
+COALESCETTL = 0
+# limits computed from the history of every channel instead of the constants
+DYNAMIC = False
+# percent used from which shares are reported by the capacity collector, 0
+# when it is not used
+CAPACITY = 0
+# appliance responses saved to or answered from a record file, and the
+# profile of a replay
+RECORDFILE = ""
+REPLAYFILE = ""
+PROFILEFILE = ""
+# other consumers of the collected channels
+PROMFILE = ""
+PROMPORT = 0
+INFLUX = ""
+PRTGTIMEOUT = 60
+ZAUTH = ("", "")
+
 
 ###############################################################################
-# Get PRTG Additional Parameters
+# Get PRTG Additional Parameters, or command line parameters when the script
+# runs outside PRTG (daemon mode).
 ###############################################################################
-prtgparams = json.loads(sys.argv[1:][0])
-params = str.split(prtgparams["params"])
-opts, args = getopt.getopt(params, "h:u:p:i:e",
-                           ["host=", "username=", "password=",
-                            "include=", "exclude=", ])
-for opt, arg in opts:
-    if opt in ("-h", "--host"):
-        HOST = str(arg)
-    elif opt in ("-u", "--username"):
-        USERNAME = str(arg)
-    elif opt in ("-p", "--password"):
-        PASSWORD = str(arg)
-    elif opt in ("-e", "--exclude"):
-        EXCLUDECHECKS = arg.split(",")
-    elif opt in ("-i", "--include"):
-        INCLUDECHECKS = arg.split(",")
+def parse_params(argv):
+    """Set the parameter holders from the script arguments"""
+    global HOSTS, INVENTORY, USERNAME, PASSWORD, EXCLUDECHECKS, \
+        INCLUDECHECKS, WORKERS, CACHEDIR, DAEMONINTERVAL, WINDOW, TOPK, \
+        SELFMETRICS, TRACEFILE, CACHEDMAXAGE, USEREQUESTS, PRTGTIMEOUT, \
+        ZAUTH, DISCOVER, REFRESH, PROMFILE, PROMPORT, INFLUX, RATELIMIT, \
+        RATEBURST, COALESCETTL, DYNAMIC, RECORDFILE, REPLAYFILE, PROFILEFILE, \
+        CAPACITY
+    if argv and argv[0].startswith("{"):
+        prtgparams = json.loads(argv[0])
+        params = str.split(prtgparams["params"])
+        PRTGTIMEOUT = int(prtgparams["timeout"])
+    else:
+        params = argv
+    opts, args = getopt.getopt(params,
+                               "h:u:p:i:e:w:c:d:a:f:n:k:mt:rsg:o:l:x:q:b:j:"
+                               "yR:P:F:v:",
+                               ["host=", "username=", "password=",
+                                "include=", "exclude=", "workers=",
+                                "cachedir=", "daemon=", "cached=",
+                                "inventory=", "window=", "top=",
+                                "selfmetrics", "trace=", "requests",
+                                "discover", "refresh=", "prometheus=",
+                                "listen=", "influx=", "ratelimit=",
+                                "burst=", "coalesce=", "dynamic",
+                                "record=", "replay=", "profile=",
+                                "capacity="])
+    for opt, arg in opts:
+        if opt in ("-h", "--host"):
+            HOSTS = arg.split(",")
+        elif opt in ("-f", "--inventory"):
+            INVENTORY = str(arg)
+        elif opt in ("-u", "--username"):
+            USERNAME = str(arg)
+        elif opt in ("-p", "--password"):
+            PASSWORD = str(arg)
+        elif opt in ("-e", "--exclude"):
+            EXCLUDECHECKS = arg.split(",")
+        elif opt in ("-i", "--include"):
+            INCLUDECHECKS = arg.split(",")
+        elif opt in ("-w", "--workers"):
+            WORKERS = max(1, int(arg))
+        elif opt in ("-c", "--cachedir"):
+            CACHEDIR = str(arg)
+        elif opt in ("-d", "--daemon"):
+            DAEMONINTERVAL = max(1, int(arg))
+        elif opt in ("-a", "--cached"):
+            CACHEDMAXAGE = max(1, int(arg))
+        elif opt in ("-n", "--window"):
+            WINDOW = max(1, int(arg))
+        elif opt in ("-k", "--top"):
+            TOPK = max(1, int(arg))
+        elif opt in ("-m", "--selfmetrics"):
+            SELFMETRICS = True
+        elif opt in ("-t", "--trace"):
+            TRACEFILE = str(arg)
+        elif opt in ("-r", "--requests"):
+            USEREQUESTS = True
+        elif opt in ("-s", "--discover"):
+            DISCOVER = True
+        elif opt in ("-g", "--refresh"):
+            for item in arg.split(","):
+                check, _, tier = item.partition("=")
+                if not check:
+                    BADREFRESH.append(item)
+                elif tier in REFRESHTIERS:
+                    REFRESH[check] = REFRESHTIERS[tier]
+                elif tier.isdigit():
+                    REFRESH[check] = int(tier)
+                else:
+                    BADREFRESH.append(item)
+        elif opt in ("-o", "--prometheus"):
+            PROMFILE = str(arg)
+        elif opt in ("-l", "--listen"):
+            PROMPORT = int(arg)
+        elif opt in ("-x", "--influx"):
+            INFLUX = str(arg)
+        elif opt in ("-q", "--ratelimit"):
+            RATELIMIT = max(0.0, float(arg))
+        elif opt in ("-b", "--burst"):
+            RATEBURST = max(1, int(arg))
+        elif opt in ("-j", "--coalesce"):
+            COALESCETTL = max(0.0, float(arg))
+        elif opt in ("-y", "--dynamic"):
+            DYNAMIC = True
+        elif opt in ("-R", "--record"):
+            RECORDFILE = str(arg)
+        elif opt in ("-P", "--replay"):
+            REPLAYFILE = str(arg)
+        elif opt in ("-F", "--profile"):
+            PROFILEFILE = str(arg)
+        elif opt in ("-v", "--capacity"):
+            CAPACITY = min(100.0, max(1.0, float(arg)))
+    if RECORDFILE:
+        # every dataset of the recorded run comes from the appliance
+        COALESCETTL = 0
+    if "capacity" in INCLUDECHECKS and not CAPACITY:
+        CAPACITY = MAXWARNCAPACITY
+    if "capacity" in EXCLUDECHECKS:
+        CAPACITY = 0
+    if not CACHEDIR:
+        import tempfile
+        CACHEDIR = tempfile.gettempdir()
+    ZAUTH = (USERNAME, PASSWORD)
 
-PRTGTIMEOUT = int(prtgparams["timeout"])
 
 ###############################################################################
 # constants
 ###############################################################################
-ZAUTH = (USERNAME, PASSWORD)
-URL = "https://{}:215/api".format(HOST)
-HEADER = {"Content-Type": "application/json"}
-TIMEOUT = 20
+URL = "https://{}/api"
+PORT = 215
+HEADER = {"Content-Type": "application/json", "Accept-Encoding": "gzip"}
+# seconds kept from the PRTG timeout to print the result before it expires
+DEADLINEMARGIN = 2
+DEADLINE = None
+ACCESSRES = "/access/v1"
+# seconds a cached session token is reused, keep it below the appliance
+# session timeout so the token is not expired on the appliance side first.
+SESSIONTTL = 600
+# seconds between checks of a dataset being fetched by another sensor
+FLIGHTPOLL = 0.01
+# seconds a dataset missing in the appliance is not requested, after them it
+# is requested again in case it was created.
+MISSINGTTL = 3600
+# seconds the list of datasets of an appliance is cached with --discover
+CATALOGTTL = 3600
+# a request to a cluster head not answered after this percentile of its
+# recent response times is also sent to the peer head. Until there are
+# HEDGESAMPLES response times, the delay is HEDGEDELAY seconds.
+HEDGEPERCENTILE = 95
+HEDGESAMPLES = 20
+HEDGEDELAY = 1.0
+HEDGEMINDELAY = 0.05
+# named refresh tiers for --refresh, in seconds between requests
+REFRESHTIERS = {"scan": 0, "5m": 300, "15m": 900, "hourly": 3600,
+                "daily": 86400}
 CPURES = "/analytics/v1/datasets/cpu.utilization/data?start=now&seconds=1"
 NFS2RES = "/analytics/v1/datasets/nfs2.ops/data?start=now&seconds=1"
 NFS3RES = "/analytics/v1/datasets/nfs3.ops/data?start=now&seconds=1"
@@ -77,6 +258,54 @@ ARCRES = "/analytics/v1/datasets/arc.hitratio/data?start=now&seconds=1"
 HTTPRES = "/analytics/v1/datasets/http.reqs/data?start=now&seconds=1"
 SFTPRES = "/analytics/v1/datasets/sftp.kilobytes/data?start=now&seconds=1"
 FTPRES = "/analytics/v1/datasets/ftp.kilobytes/data?start=now&seconds=1"
+# breakdown datasets, they must be created in the appliance analytics
+NFS3CLIENTRES = ("/analytics/v1/datasets/nfs3.ops[client]/data"
+                 "?start=now&seconds=1")
+NFS4CLIENTRES = ("/analytics/v1/datasets/nfs4.ops[client]/data"
+                 "?start=now&seconds=1")
+ISCSILUNRES = "/analytics/v1/datasets/iscsi.ops[lun]/data?start=now&seconds=1"
+DISKIORES = "/analytics/v1/datasets/io.ops[disk]/data?start=now&seconds=1"
+# latency histograms, keys are the latency of each bucket in microseconds
+NFS3LATENCYRES = ("/analytics/v1/datasets/nfs3.ops[latency]/data"
+                  "?start=now&seconds=1")
+NFS4LATENCYRES = ("/analytics/v1/datasets/nfs4.ops[latency]/data"
+                  "?start=now&seconds=1")
+ISCSILATENCYRES = ("/analytics/v1/datasets/iscsi.ops[latency]/data"
+                   "?start=now&seconds=1")
+LATENCYPERCENTILES = (50, 95, 99)
+DATASETSRES = "/analytics/v1/datasets"
+DATASETRES = "/analytics/v1/datasets/{}/data?start=now&seconds=1"
+# storage resources walked by the capacity collector
+POOLSRES = "/storage/v1/pools"
+POOLRES = "/storage/v1/pools/{}"
+PROJECTSRES = "/storage/v1/pools/{}/projects"
+SHARESRES = "/storage/v1/pools/{}/projects/{}/{}"
+SHARERES = "/storage/v1/pools/{}/projects/{}/{}/{}"
+SHAREKINDS = ("filesystems", "luns")
+# seconds between walks of all the shares of an appliance, in between only
+# the pools and the shares that can be reported are requested
+CAPACITYWALK = 3600
+# shares this many points under the capacity percent are requested between
+# walks too, so they are reported as soon as they go over it
+CAPACITYMARGIN = 5
+# shares over the capacity percent added as channels, the fullest first
+CAPACITYMAX = 20
+# bytes read at a time from streamed responses
+STREAMCHUNK = 64 * 1024
+# unit and custom unit of discovered datasets, by the end of their name
+DATASETUNITS = [
+    (".ops", "Custom", "Ops/sec"),
+    (".kilobytes", "Custom", "Kilobytes/sec"),
+    (".reqs", "Custom", "Request/sec"),
+    (".utilization", "Percent", None),
+    (".hitratio", "Percent", None)
+]
+# window query replacing start=now&seconds=1, start is in appliance UTC time
+WINDOWQUERY = "start={}&seconds={}"
+WINDOWSTART = "%Y%m%dT%H:%M:%S"
+# responses from this size are parsed with orjson or ujson when installed,
+# for smaller ones importing them costs more than what they save.
+FASTJSONSIZE = 256 * 1024
 
 ###############################################################################
 # Limit Max Warnings and Limit Max Error values.
@@ -93,100 +322,1369 @@ MAXWARNSMB2, MAXERRORSMB2 = 40000, 80000
 MAXWARNSMB3, MAXERRORSMB3 = 40000, 80000
 MAXWARNNIC, MAXERRORNIC = 500000, 1000000
 MINWARNARC, MINERRORARC = 80, 60
+# latency limits in milliseconds
+MAXWARNNFS3LATENCY, MAXERRORNFS3LATENCY = 20, 50
+MAXWARNNFS4LATENCY, MAXERRORNFS4LATENCY = 20, 50
+MAXWARNISCSILATENCY, MAXERRORISCSILATENCY = 20, 50
 MAXWARNHTTP, MAXERRORHTTP = 6000, 10000
 MAXWARNSFTP, MAXERRORSFTP = 200000, 300000
 MAXWARNFTP, MAXERRORFTP = 200000, 300000
+# percent used of pools and shares
+MAXWARNCAPACITY, MAXERRORCAPACITY = 85, 95
+
+###############################################################################
+# Dynamic limits (--dynamic): from the last HISTORYSIZE values of a channel,
+# taken at least HISTORYSTEP seconds apart, once there are HISTORYMIN of them.
+# Max limits are a high percentile times a margin, min limits a low
+# percentile divided by it. Max limits are never under DYNAMICFLOOR of the
+# constant limits, so a channel idle for a week doesn't warn on its first
+# operations.
+###############################################################################
+HISTORYSIZE = 2016
+HISTORYSTEP = 10
+HISTORYMIN = 100
+DYNAMICWARNING = (95, 5, 1.2)
+DYNAMICERROR = (99, 1, 1.5)
+DYNAMICFLOOR = 0.1
 
 
 ###############################################################################
-# Custom Sensor class.
-###############################################################################
-class AdvancedCustomSensorResult(CustomSensorResult):
-    """Extend CustomSensorResult to include additional parameters"""
-
-    def add_channel(
-            self,
-            channel_name,
-            is_limit_mode=False,
-            limit_max_error=None,
-            limit_max_warning=None,
-            limit_min_error=None,
-            limit_min_warning=None,
-            limit_error_msg=None,
-            limit_warning_msg=None,
-            decimal_mode=None,
-            mode=None,
-            value=None,
-            unit='Custom',
-            is_float=False,
-            value_lookup=None,
-            show_chart=True,
-            custom_unit=None,
-            warning=False,
-            primary_channel=False
-    ):
-        channel = {}
-
-        # Process in parent class
-        super(AdvancedCustomSensorResult, self).add_channel(
-            channel_name, is_limit_mode, limit_max_error,
-            limit_max_warning, limit_min_error, limit_min_warning,
-            limit_error_msg, limit_warning_msg,
-            decimal_mode, mode, value, unit, is_float, value_lookup,
-            show_chart, warning, primary_channel)
-
-        # Get channel from the original class
-        if primary_channel:
-            channel = self.channels[0]
-        else:
-            channel = self.channels[len(self.channels) - 1]
+# Sensor result, built without a dict per channel. Channel fields other than
+# the name and value come from a template serialized once per set of channel
+# parameters, so breakdown and fleet results with hundreds of channels are
+# mostly string joins. Channels are (name, value, template) tuples.
+###############################################################################
+PRTGUNITS = {"BytesBandwidth", "BytesMemory", "BytesDisk", "Temperature",
+             "Percent", "TimeResponse", "TimeSeconds", "Custom", "Count",
+             "CPU", "BytesFile", "SpeedDisk", "SpeedNet", "TimeHours"}
+CUSTOMUNITS = {"Ops/sec", "Kilobytes/sec", "Request/sec"}
+# templates by the tuple of the channel parameters
+TEMPLATES = {}
+# templates kept between collections, dynamic limits make new ones on every
+# run of the daemon
+TEMPLATESMAX = 1024
+# unit of the channels of each template, for the exporters
+UNITS = {}
+
+
+def channel_template(key):
+    """Return the PRTG fields of a channel with the parameters in key, in
+    the order of add_channel, except its name and value, as a json fragment
+    starting with a comma."""
+    (is_limit_mode, limit_max_error, limit_max_warning, limit_min_error,
+     limit_min_warning, limit_error_msg, limit_warning_msg, decimal_mode,
+     mode, unit, is_float, value_lookup, show_chart, custom_unit,
+     warning) = key
+    fields = OrderedDict()
+    fields["unit"] = unit if unit in PRTGUNITS else "Custom"
+    if custom_unit in CUSTOMUNITS:
+        fields["CustomUnit"] = custom_unit
+    if is_float:
+        fields["float"] = 1
+    if is_limit_mode:
+        fields["LimitMode"] = 1
+        for name, limit in (("LimitMaxError", limit_max_error),
+                            ("LimitMaxWarning", limit_max_warning),
+                            ("LimitMinError", limit_min_error),
+                            ("LimitMinWarning", limit_min_warning),
+                            ("LimitErrorMsg", limit_error_msg),
+                            ("LimitWarningMsg", limit_warning_msg)):
+            if limit is not None:
+                fields[name] = limit
+    if decimal_mode in ("Auto", "All"):
+        fields["DecimalMode"] = decimal_mode
+    if mode in ("Absolute", "Difference"):
+        fields["Mode"] = mode
+    if value_lookup is not None:
+        fields["ValueLookup"] = value_lookup
+    if not show_chart:
+        fields["ShowChart"] = 0
+    if warning:
+        fields["Warning"] = 1
+    return ", " + json.dumps(fields)[1:-1]
+
+
+def new_template(key):
+    """Make the template of the channel parameters in key, and keep it with
+    its unit"""
+    template = TEMPLATES[key] = channel_template(key)
+    fields = json.loads("{" + template[1:] + "}")
+    UNITS[template] = fields.get("CustomUnit", fields["unit"])
+    return template
+
+
+def template_of(is_limit_mode=False, limit_max_error=None,
+                limit_max_warning=None, limit_min_error=None,
+                limit_min_warning=None, limit_error_msg=None,
+                limit_warning_msg=None, decimal_mode=None, mode=None,
+                unit="Custom", is_float=False, value_lookup=None,
+                show_chart=True, custom_unit=None, warning=False):
+    """Return the template of these channel parameters, made once for every
+    set of them"""
+    key = (is_limit_mode, limit_max_error, limit_max_warning,
+           limit_min_error, limit_min_warning, limit_error_msg,
+           limit_warning_msg, decimal_mode, mode, unit, is_float,
+           value_lookup, show_chart, custom_unit, warning)
+    return TEMPLATES.get(key) or new_template(key)
+
+
+def trim_templates():
+    """Forget the templates and their units when there are TEMPLATESMAX,
+    between collections so no channel loses its unit"""
+    if len(TEMPLATES) >= TEMPLATESMAX:
+        TEMPLATES.clear()
+        UNITS.clear()
+
+
+def json_value(value):
+    """Return the json text of a channel value"""
+    if type(value) is int:
+        return str(value)
+    return json.dumps(value)
+
+
+class SensorResult(object):
+    """Channels, message and error of a PRTG Python Script Advanced sensor,
+    the same result paepy CustomSensorResult gives."""
+
+    __slots__ = ("channels", "sensor_message", "error")
 
-        # Additional parameters
-        if custom_unit is not None and self.__is_customunit_valid(custom_unit):
-            channel['CustomUnit'] = custom_unit
+    def __init__(self, text=None):
+        self.channels = []
+        self.sensor_message = "OK" if text is None else text
+        self.error = None
 
-        # Re-save channel
+    def add_channel(self, channel_name, value=None, primary_channel=False,
+                    is_limit_mode=False, limit_max_error=None,
+                    limit_max_warning=None, limit_min_error=None,
+                    limit_min_warning=None, limit_error_msg=None,
+                    limit_warning_msg=None, decimal_mode=None, mode=None,
+                    unit="Custom", is_float=False, value_lookup=None,
+                    show_chart=True, custom_unit=None, warning=False):
+        """Add a channel, the first one if primary_channel is set. Other
+        parameters are the ones of paepy add_channel, and custom_unit. The
+        template lookup is the one of template_of, inlined as this runs for
+        every channel."""
+        key = (is_limit_mode, limit_max_error, limit_max_warning,
+               limit_min_error, limit_min_warning, limit_error_msg,
+               limit_warning_msg, decimal_mode, mode, unit, is_float,
+               value_lookup, show_chart, custom_unit, warning)
+        channel = (channel_name, value,
+                   TEMPLATES.get(key) or new_template(key))
         if primary_channel:
-            self.channels[0] = channel
+            self.channels.insert(0, channel)
         else:
-            self.channels[len(self.channels) - 1] = channel
+            self.channels.append(channel)
 
-    @staticmethod
-    def __is_customunit_valid(unit):
+    def add_channels(self, named_values, **kwargs):
+        """Add a channel for each (name, value) pair, all of them with the
+        same parameters."""
+        template = template_of(**kwargs)
+        self.channels.extend([(name, value, template)
+                              for name, value in named_values])
 
-        valid_unit = {
-            "Ops/sec",
-            "Kilobytes/sec",
-            "Request/sec"
-        }
+    def add_error(self, text):
+        """Make the result an error, with text as its message"""
+        self.error = text
 
-        return bool(unit in valid_unit)
+    def get_json_result(self):
+        """Return the result in PRTG json format, serialized in one pass"""
+        if self.error is not None:
+            return json.dumps({"prtg": {"error": 1, "text": self.error}})
+        encode = json.encoder.encode_basestring_ascii
+        result = ",".join(["{\"name\": " + encode(name) + template +
+                           ", \"value\": " + json_value(value) + "}"
+                           for name, value, template in self.channels])
+        if result:
+            result = "\"result\": [" + result + "], "
+        return ("{\"prtg\": {" + result + "\"text\": " +
+                encode(self.sensor_message) + "}}")
 
 
 ###############################################################################
 # return channels
 ###############################################################################
-channels = AdvancedCustomSensorResult()
+channels = SensorResult()
 
+###############################################################################
+# Response decoding
+###############################################################################
+FASTLOADS = []
 
-def cpu():
+
+def json_loads(content):
+    """Parse response bytes, without decoding them to str first. Big
+    responses are parsed with orjson or ujson when one is installed."""
+    if len(content) >= FASTJSONSIZE:
+        if not FASTLOADS:
+            try:
+                from orjson import loads
+            except ImportError:
+                try:
+                    from ujson import loads
+                except ImportError:
+                    loads = None
+            FASTLOADS.append(loads)
+        if FASTLOADS[0] is not None:
+            return FASTLOADS[0](content)
+    return json.loads(content)
+
+
+def stream_items(chunks, key):
+    """Yield the objects of the list key of a json response read as chunks
+    of bytes, decoding one object at a time as the chunks arrive, so neither
+    the response nor the whole list is ever kept in memory."""
+    import codecs
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder("utf-8")()
+    chunks = iter(chunks)
+    buffer, start = "", -1
+    while start < 0:
+        chunk = next(chunks, None)
+        if chunk is None:
+            raise ValueError("no {} list in the response".format(key))
+        buffer += text.decode(chunk)
+        found = buffer.find('"{}"'.format(key))
+        if found >= 0:
+            start = buffer.find("[", found)
+    position = start + 1
+    while True:
+        while position < len(buffer) and buffer[position] in " \t\r\n,":
+            position += 1
+        if buffer.startswith("]", position):
+            return
+        try:
+            if position == len(buffer):
+                raise ValueError("incomplete")
+            item, position = decoder.raw_decode(buffer, position)
+        except ValueError:
+            # the object continues in the next chunks
+            chunk = next(chunks, None)
+            if chunk is None:
+                raise ValueError("{} list is incomplete".format(key))
+            buffer = buffer[position:] + text.decode(chunk)
+            position = 0
+            continue
+        yield item
+
+
+###############################################################################
+# Time budget
+###############################################################################
+class DeadlineExceeded(Exception):
+    """No time left to request a dataset"""
+
+
+class DatasetMissing(Exception):
+    """The dataset doesn't exist in the appliance"""
+
+
+def time_left():
+    """Return the seconds left until DEADLINE, to use as the timeout of the
+    next request. Raise DeadlineExceeded when there are none."""
+    left = DEADLINE - time.time()
+    if left <= 0:
+        raise DeadlineExceeded()
+    return left
+
+
+###############################################################################
+# Cache files
+###############################################################################
+def cache_path(name, kind):
+    """Return the path of a cache file of kind for name"""
+    filename = "prtgzfssa_{}.{}".format(name, kind)
+    return os.path.join(CACHEDIR, re.sub(r"[^\w.-]", "_", filename))
+
+
+def read_cache(name, kind):
+    """Return the content of a cache file, None if it can't be read"""
+    try:
+        with open(cache_path(name, kind)) as cache:
+            return json.load(cache)
+    except Exception:
+        return None
+
+
+def write_cache(name, kind, content):
+    """Replace a cache file in one step, so readers never see it half written.
+    Cache files are readable only by the sensor user."""
+    path = cache_path(name, kind)
+    tmp = "{}.{}".format(path, os.getpid())
+    try:
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as cache:
+            json.dump(content, cache)
+        os.replace(tmp, path)
+    except Exception:
+        # on Windows the cache file can't be replaced while another
+        # process has it open, don't leave the temporary file behind
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+
+
+def drop_cache(name, kind):
+    """Remove a cache file"""
+    try:
+        os.remove(cache_path(name, kind))
+    except OSError:
+        pass
+
+
+###############################################################################
+# Request rate limit shared by the sensor processes of this server: a token
+# bucket per appliance in a cache file, updated under a file lock.
+###############################################################################
+def lock_file(fd, wait=True):
+    """Take an exclusive lock on an open file, waiting for it unless wait is
+    False. Return False if the file is locked and wait is False."""
     try:
-        req = requests.get(URL + CPURES,
-                           auth=ZAUTH,
-                           verify=False,
-                           headers=HEADER,
-                           timeout=TIMEOUT)
-        j = json.loads(req.text)
+        import fcntl
+    except ImportError:
+        import msvcrt
+        os.lseek(fd, 0, os.SEEK_SET)
+        try:
+            msvcrt.locking(fd, msvcrt.LK_LOCK if wait else msvcrt.LK_NBLCK,
+                           1)
+        except OSError:
+            if wait:
+                raise
+            return False
+        return True
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX if wait else
+                    fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except (IOError, OSError):
+        if wait:
+            raise
+        return False
+    return True
+
+
+def unlock_file(fd):
+    """Release the lock taken with lock_file"""
+    try:
+        import fcntl
+    except ImportError:
+        import msvcrt
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+        return
+    fcntl.flock(fd, fcntl.LOCK_UN)
+
+
+def take_token(name, rate, burst):
+    """Take a token from the bucket of name, refilled with rate tokens per
+    second up to burst, and return the seconds to wait before using it. A
+    token not there yet is reserved, so the processes waiting for tokens
+    send their requests one every 1 / rate seconds instead of all at once.
+    Raise DeadlineExceeded if the wait is longer than the time left."""
+    fd = os.open(cache_path(name, "bucket"), os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        lock_file(fd)
+        try:
+            state = os.read(fd, 64).split()
+            now = time.time()
+            if len(state) == 2:
+                tokens, last = float(state[0]), float(state[1])
+                tokens = min(burst, tokens + (now - last) * rate)
+            else:
+                tokens = burst
+            wait = max(0.0, (1 - tokens) / rate)
+            if wait > time_left():
+                raise DeadlineExceeded()
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.ftruncate(fd, 0)
+            os.write(fd, "{!r} {!r}".format(tokens - 1, now).encode())
+        finally:
+            unlock_file(fd)
+    finally:
+        os.close(fd)
+    return wait
+
+
+###############################################################################
+# HTTPS transports
+###############################################################################
+class LightResponse(object):
+    """Response of a LightSession, with the requests.Response fields used,
+    and the times it was sent again on another connection (retries)."""
+
+    def __init__(self, status_code, headers, content, retries=0):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.retries = retries
+
+    def iter_content(self, chunk_size):
+        for start in range(0, len(self.content), chunk_size):
+            yield self.content[start:start + chunk_size]
+
+    def close(self):
+        pass
+
+
+class LightStream(object):
+    """Response of a LightSession streamed request, read in chunks with
+    iter_content. Its connection is kept alive when it is closed after the
+    whole response was read."""
+
+    def __init__(self, session, conn, resp, retries=0):
+        self.session = session
+        self.conn = conn
+        self.resp = resp
+        self.status_code = resp.status
+        self.headers = resp.msg
+        self.retries = retries
+
+    def iter_content(self, chunk_size):
+        gzipped = self.resp.getheader("Content-Encoding") == "gzip"
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        while True:
+            chunk = self.resp.read(chunk_size)
+            if not chunk:
+                break
+            yield decompressor.decompress(chunk) if gzipped else chunk
+
+    def close(self):
+        if self.conn is None:
+            return
+        if self.resp.isclosed() and not self.resp.will_close:
+            self.session.idle.append(self.conn)
+        else:
+            self.conn.close()
+        self.conn = None
+
+
+class LightSession(object):
+    """Keep-alive HTTPS client on top of http.client, with the part of the
+    requests.Session interface the checks use. It is much cheaper to import
+    than requests. Idle connections are kept to be reused by any thread, so
+    there are never more connections than requests in flight."""
+
+    def __init__(self):
+        import ssl
+        self.headers = {}
+        self.auth = None
+        self.idle = []
+        # the appliance uses a self signed certificate
+        self.context = ssl._create_unverified_context()
+
+    def connection(self, netloc, timeout):
+        """Return an idle connection, or a new one, and if it is reused"""
+        import http.client
+        try:
+            conn, reused = self.idle.pop(), True
+        except IndexError:
+            conn, reused = http.client.HTTPSConnection(
+                netloc, context=self.context), False
+        conn.timeout = timeout
+        if conn.sock is not None:
+            conn.sock.settimeout(timeout)
+        return conn, reused
+
+    def request(self, method, url, auth=None, timeout=None, stream=False):
+        from urllib.parse import urlsplit
+        parts = urlsplit(url)
+        path = parts.path + ("?" + parts.query if parts.query else "")
+        headers = dict(self.headers)
+        auth = auth or self.auth
+        if auth is not None:
+            credentials = "{}:{}".format(*auth).encode("utf-8")
+            headers["Authorization"] = "Basic " + binascii.b2a_base64(
+                credentials).decode("ascii").strip()
+        import http.client
+        retries = 0
+        while True:
+            conn, reused = self.connection(parts.netloc, timeout)
+            try:
+                conn.request(method, path, headers=headers)
+                resp = conn.getresponse()
+                break
+            except (http.client.RemoteDisconnected, ConnectionResetError,
+                    BrokenPipeError):
+                conn.close()
+                # the appliance may have closed an idle kept alive
+                # connection before answering, try again on another one.
+                # Timeouts are not retried, the appliance is only slow.
+                if not reused:
+                    raise
+                retries += 1
+            except Exception:
+                conn.close()
+                raise
+        if stream:
+            return LightStream(self, conn, resp, retries)
+        try:
+            content = resp.read()
+        except Exception:
+            conn.close()
+            raise
+        if resp.will_close:
+            conn.close()
+        else:
+            self.idle.append(conn)
+        if resp.getheader("Content-Encoding") == "gzip":
+            content = zlib.decompress(content, 16 + zlib.MAX_WBITS)
+        return LightResponse(resp.status, resp.msg, content, retries)
+
+    def get(self, url, timeout=None, stream=False):
+        return self.request("GET", url, timeout=timeout, stream=stream)
+
+    def post(self, url, auth=None, timeout=None):
+        return self.request("POST", url, auth=auth, timeout=timeout)
+
+
+###############################################################################
+# Record and replay of the appliance responses
+###############################################################################
+RECORDLOCK = threading.Lock()
+# responses of the record file by (host, dataset), and by (None, dataset)
+REPLAY = {}
+# functions listed in the profile summary of a replay
+REPLAYTOP = 30
+
+
+def record_response(host, dataset, status, seconds, content):
+    """Append a response of the appliance to RECORDFILE, one json object per
+    line with its dataset (datasets for the datasets list, the path for
+    storage resources), status, seconds it took and content."""
+    line = json.dumps({"host": host, "dataset": dataset, "status": status,
+                       "seconds": seconds,
+                       "content": content.decode("utf-8", "replace")})
+    with RECORDLOCK:
+        with open(RECORDFILE, "a") as record:
+            record.write(line + "\n")
+
+
+def load_record(path):
+    """Load the responses of a record file into REPLAY. The responses of a
+    dataset are answered in turn, for replays of records of several runs."""
+    from itertools import cycle
+    responses = {}
+    with open(path) as record:
+        for line in record:
+            saved = json.loads(line)
+            response = (saved["status"], saved["content"].encode("utf-8"))
+            for host in (saved["host"], None):
+                responses.setdefault((host, saved["dataset"]),
+                                     []).append(response)
+    REPLAY.clear()
+    REPLAY.update((key, cycle(saved)) for key, saved in responses.items())
+
+
+class ReplaySession(object):
+    """Session answering with the responses of the record file, without
+    network. Datasets not in the record are answered 404."""
+
+    def __init__(self, host):
+        self.host = host
+        self.headers = {}
+        self.auth = None
+
+    def get(self, url, timeout=None, stream=False):
+        path = url.split("/api", 1)[1].split("?")[0]
+        if path == DATASETSRES:
+            dataset = "datasets"
+        elif path.startswith(DATASETSRES):
+            dataset = dataset_name(path)
+        else:
+            dataset = path
+        responses = REPLAY.get((self.host, dataset),
+                               REPLAY.get((None, dataset)))
+        if responses is None:
+            return LightResponse(404, {}, b'{"fault": {"code": 404}}')
+        status, content = next(responses)
+        return LightResponse(status, {}, content)
+
+    def post(self, url, auth=None, timeout=None):
+        return LightResponse(201, {"X-Auth-Session": "replay"}, b"")
+
+
+def requests_session(workers):
+    """Return a requests session keeping up to workers connections alive"""
+    import requests
+    # from requests.packages.urllib3.exceptions import InsecureRequestWarning  # for older requests
+    from urllib3.exceptions import InsecureRequestWarning  # for newer requests
+    # to disable warning
+    # InsecureRequestWarning: Unverified HTTPS request is being made.
+    # Adding certificate verification is strongly advised. See:
+    # https://urllib3.readthedocs.io/en/latest/advanced-usage.html#ssl-warnings
+    requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
+    session = requests.Session()
+    session.verify = False
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                            pool_maxsize=workers)
+    session.mount("https://", adapter)
+    return session
+
+
+###############################################################################
+# Appliance connection
+###############################################################################
+class Appliance(object):
+    """Shared session to one appliance and the dataset requests already sent
+    to it, by resource. host can be <head>+<peer head> for a cluster, dataset
+    requests are then hedged to the peer head."""
+
+    def __init__(self, host, username=None, password=None):
+        host, _, peer = host.partition("+")
+        self.host = host
+        if ":" in host:
+            # host:port, for appliances behind a proxy or the mock appliance
+            self.url = URL.format(host)
+        else:
+            self.url = URL.format("{}:{}".format(host, PORT))
+        if username is None:
+            self.auth = ZAUTH
+        else:
+            self.auth = (username, password)
+        self.name = "{}_{}".format(host, self.auth[0])
+        self.session = None
+        self.lock = threading.Lock()
+        self.prefetched = {}
+        # timings of the requests in the current run, by dataset
+        self.stats = {}
+        # datasets missing in the appliance, with when to request them again
+        self.missing = {}
+        self.missing_changed = False
+        # active datasets of the appliance with --discover, None without it
+        self.catalog = None
+        # last samples of the datasets with a refresh tier, by dataset, and
+        # the ones still fresh in the current run, by resource
+        self.samples = {}
+        self.samples_changed = False
+        self.tiered = set()
+        self.cached = {}
+        # other head of a cluster, and the recent response times of this one
+        self.peer = None
+        if peer:
+            self.peer = Appliance(peer, *self.auth)
+        self.latencies = deque(maxlen=100)
+        self.workers = 1
+        self.hedges = None
+
+    def read_token(self):
+        """Return the cached session token if it didn't expire, else None"""
+        saved = read_cache(self.name, "session")
+        if saved is not None and saved["expires"] > time.time():
+            return saved["token"]
+        return None
+
+    def save_token(self, token):
+        """Cache the session token"""
+        write_cache(self.name, "session",
+                    {"token": token, "expires": time.time() + SESSIONTTL})
+
+    def throttle(self, stats):
+        """Wait for a token of the appliance rate limit, if there is one.
+        Return the seconds waited, also added to stats["throttle"]."""
+        if not RATELIMIT:
+            return 0.0
+        wait = take_token(self.host, RATELIMIT,
+                          RATEBURST or max(1, int(RATELIMIT)))
+        stats["throttle"] = stats.get("throttle", 0.0) + wait
+        time.sleep(wait)
+        return wait
+
+    def login(self, renew=False):
+        """Authenticate the session with a session token, using the cached
+        one unless renew is set. If the appliance doesn't give a token,
+        requests fall back to basic auth."""
+        token = None if renew else self.read_token()
+        if token is None:
+            started = time.time()
+            stats = {"retries": 0, "bytes": 0}
+            self.stats["login"] = stats
+            try:
+                started += self.throttle(stats)
+                req = self.session.post(self.url + ACCESSRES,
+                                        auth=self.auth,
+                                        timeout=time_left())
+                req.close()
+                token = req.headers.get("X-Auth-Session")
+                stats["retries"] += getattr(req, "retries", 0)
+                stats["status"] = req.status_code
+                stats["response"] = time.time() - started
+            except Exception as error:
+                stats["error"] = type(error).__name__
+            if token is None:
+                self.session.headers.pop("X-Auth-Session", None)
+                self.session.auth = self.auth
+                return
+            self.save_token(token)
+        self.session.auth = None
+        self.session.headers["X-Auth-Session"] = token
+
+    def open_session(self, workers):
+        """Create the session shared by all checks, keeping up to workers
+        connections alive to the appliance."""
+        if REPLAYFILE:
+            self.session = ReplaySession(self.host)
+        elif USEREQUESTS:
+            self.session = requests_session(workers)
+        else:
+            self.session = LightSession()
+        self.session.headers.update(HEADER)
+        if not RECORDFILE:
+            # a recorded run asks the appliance for everything, so its
+            # replay doesn't depend on the cache directory it ran with
+            self.missing = read_cache(self.name, "missing") or {}
+            self.samples = read_cache(self.name, "samples") or {}
+        self.workers = workers
+        if self.peer is not None:
+            self.latencies.extend(read_cache(self.name, "latency") or [])
+        self.login()
+
+    def discover(self):
+        """Return the active (not suspended) datasets of the appliance, from
+        the catalog cache if it didn't expire. Return None if they can't be
+        listed."""
+        saved = None if RECORDFILE else read_cache(self.name, "catalog")
+        if saved is not None and saved["expires"] > time.time():
+            self.catalog = set(saved["datasets"])
+            return self.catalog
+        try:
+            self.throttle({})
+            started = time.time()
+            req = self.session.get(self.url + DATASETSRES,
+                                   timeout=time_left())
+            content = req.content
+            req.close()
+            if RECORDFILE:
+                record_response(self.host, "datasets", req.status_code,
+                                time.time() - started, content)
+            datasets = json_loads(content)["datasets"]
+        except Exception:
+            self.catalog = None
+            return None
+        self.catalog = set(d["name"] for d in datasets
+                           if not d.get("suspended", False))
+        write_cache(self.name, "catalog",
+                    {"expires": time.time() + CATALOGTTL,
+                     "datasets": sorted(self.catalog)})
+        return self.catalog
+
+    def listed(self, resource):
+        """Return False if the appliance datasets were discovered and the
+        dataset of resource is not one of the active ones."""
+        return self.catalog is None or dataset_name(resource) in self.catalog
+
+    def available(self, resource):
+        """Return False if the dataset of resource is missing in the
+        appliance and it is not time to request it again."""
+        return self.missing.get(dataset_name(resource), 0) <= time.time()
+
+    def mark_missing(self, resource, missing):
+        """Record if the dataset of resource is missing in the appliance"""
+        dataset = dataset_name(resource)
+        with self.lock:
+            if missing:
+                self.missing[dataset] = time.time() + MISSINGTTL
+            elif self.missing.pop(dataset, None) is None:
+                return
+            self.missing_changed = True
+
+    def save_missing(self):
+        """Cache the missing datasets if they changed. Prefetches still
+        running after the deadline can change them, so a copy is saved."""
+        with self.lock:
+            if not self.missing_changed:
+                return
+            missing = dict(self.missing)
+            self.missing_changed = False
+        write_cache(self.name, "missing", missing)
+
+    def reuse_samples(self, ttls):
+        """Take the cached samples of the resources in ttls (seconds between
+        requests, by resource) younger than their ttl, so they are not
+        requested in this run. Their age is kept in self.stats."""
+        self.tiered = set(ttls)
+        self.cached = {}
+        for resource, ttl in ttls.items():
+            sample = self.samples.get(dataset_name(resource))
+            if sample is None or sample["time"] + ttl <= time.time():
+                continue
+            self.cached[resource] = Dataset(sample["values"],
+                                            sample["breakdowns"])
+            self.stats[dataset_name(resource)] = {
+                "retries": 0, "bytes": 0,
+                "age": time.time() - sample["time"]}
+
+    def keep_sample(self, resource, j):
+        """Remember the sample of a dataset with a refresh tier"""
+        with self.lock:
+            self.samples[dataset_name(resource)] = {
+                "time": time.time(), "values": j.values,
+                "breakdowns": j.breakdowns}
+            self.samples_changed = True
+
+    def save_samples(self):
+        """Cache the samples of datasets with a refresh tier if they
+        changed. They are merged under a file lock with the samples cached
+        by other sensors of the appliance since this one read them, keeping
+        the newest of each dataset, so sensors with other tiers don't drop
+        each other's samples. Prefetches still running after the deadline
+        can change them, so a copy is merged."""
+        with self.lock:
+            if not self.samples_changed:
+                return
+            kept = dict(self.samples)
+            self.samples_changed = False
+        try:
+            fd = os.open(cache_path(self.name, "samplelock"),
+                         os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                lock_file(fd)
+                try:
+                    samples = read_cache(self.name, "samples") or {}
+                    for dataset, sample in kept.items():
+                        if dataset not in samples or \
+                                samples[dataset]["time"] < sample["time"]:
+                            samples[dataset] = sample
+                    write_cache(self.name, "samples", samples)
+                finally:
+                    unlock_file(fd)
+            finally:
+                os.close(fd)
+        except OSError:
+            # not cached, the next run requests the datasets again
+            pass
+
+    def get(self, path, stats, stream=False):
+        """Send a GET request for path, renewing the session token once if
+        the appliance rejects it. Return the response and the seconds spent
+        waiting for the rate limit, also kept in stats with the retries (the
+        requests sent again on another connection or with a new token)."""
+        throttled = self.throttle(stats)
+        token = self.session.headers.get("X-Auth-Session")
+        req = self.session.get(self.url + path, timeout=time_left(),
+                               stream=stream)
+        stats["retries"] += getattr(req, "retries", 0)
+        if req.status_code == 401 and token is not None:
+            # cached token expired on the appliance, get a new one once
+            req.close()
+            stats["retries"] += 1
+            with self.lock:
+                if self.session.headers.get("X-Auth-Session") == token:
+                    drop_cache(self.name, "session")
+                    self.login(renew=True)
+            throttled += self.throttle(stats)
+            req = self.session.get(self.url + path, timeout=time_left(),
+                                   stream=stream)
+            stats["retries"] += getattr(req, "retries", 0)
+        return req, throttled
+
+    def request_dataset(self, resource, submitted=None):
+        """Get a dataset resource from the appliance and decode it. Its
+        timings are kept in self.stats: seconds queued waiting for a worker,
+        until the response headers (wait, including the connection setup when
+        a new one is needed), until the whole response (response) and to
+        parse it, besides the bytes received and retries. With a rate limit,
+        the seconds waiting for it (throttle) are not part of the others."""
+        started = time.time()
+        stats = {"retries": 0, "bytes": 0, "start": started - STARTED,
+                 "queued": started - submitted if submitted else 0.0}
+        self.stats[dataset_name(resource)] = stats
+        try:
+            req, throttled = self.get(window_resource(resource), stats)
+            started += throttled
+            stats["wait"] = time.time() - started
+            content = req.content
+            req.close()
+            stats["status"] = req.status_code
+            if RECORDFILE:
+                record_response(self.host, dataset_name(resource),
+                                req.status_code, time.time() - started,
+                                content)
+            self.mark_missing(resource, req.status_code == 404)
+            if req.status_code == 404:
+                raise DatasetMissing(dataset_name(resource))
+            stats["response"] = time.time() - started
+            stats["bytes"] = len(content)
+            parsing = time.time()
+            j = extract(json_loads(content), "[" in dataset_name(resource))
+            stats["parse"] = time.time() - parsing
+            if resource in self.tiered:
+                self.keep_sample(resource, j)
+            self.latencies.append(stats["response"])
+            return j
+        except Exception as error:
+            stats["error"] = type(error).__name__
+            raise
+
+    def fetch_dataset(self, resource, submitted=None):
+        """Get a dataset resource, from either head of a cluster"""
+        if self.peer is None:
+            return self.request_dataset(resource, submitted)
+        return self.hedged_dataset(resource, submitted)
+
+    def coalesced_dataset(self, resource, submitted=None):
+        """Get a dataset resource once for all the sensor processes of this
+        server asking for it at the same time. The first one takes the
+        dataset flight lock, fetches it and shares it in the cache
+        directory; the others wait for the lock and use the shared dataset
+        while it is younger than COALESCETTL."""
+        if not COALESCETTL:
+            return self.fetch_dataset(resource, submitted)
+        name = "{}_{}_{}".format(self.name, dataset_name(resource), WINDOW)
+        j = self.shared_dataset(name, resource)
+        if j is not None:
+            return j
+        fd = os.open(cache_path(name, "flight"), os.O_RDWR | os.O_CREAT,
+                     0o600)
+        try:
+            while not lock_file(fd, wait=False):
+                if time_left() < FLIGHTPOLL:
+                    raise DeadlineExceeded()
+                time.sleep(FLIGHTPOLL)
+            try:
+                j = self.shared_dataset(name, resource)
+                if j is not None:
+                    return j
+                fetched = time.time()
+                j = self.fetch_dataset(resource, submitted)
+                write_cache(name, "shared",
+                            {"time": fetched, "values": j.values,
+                             "breakdowns": j.breakdowns})
+                return j
+            finally:
+                unlock_file(fd)
+        finally:
+            os.close(fd)
+
+    def shared_dataset(self, name, resource):
+        """Return the dataset another sensor shared as name if it is younger
+        than COALESCETTL, else None. Its age is kept in self.stats."""
+        shared = read_cache(name, "shared")
+        if shared is None or shared["time"] + COALESCETTL <= time.time():
+            return None
+        j = Dataset(shared["values"], shared["breakdowns"])
+        self.stats[dataset_name(resource)] = {
+            "retries": 0, "bytes": 0, "shared": time.time() - shared["time"]}
+        if resource in self.tiered:
+            self.keep_sample(resource, j)
+        return j
+
+    def hedge_delay(self):
+        """Return the seconds to wait for this head before hedging a request
+        to the peer head: HEDGEPERCENTILE of the recent response times."""
+        if len(self.latencies) < HEDGESAMPLES:
+            return HEDGEDELAY
+        latencies = sorted(self.latencies)
+        rank = -(-len(latencies) * HEDGEPERCENTILE // 100) - 1
+        return max(HEDGEMINDELAY, latencies[rank])
+
+    def peer_dataset(self, resource):
+        """Get a dataset resource from the peer head, opening its session
+        the first time."""
+        with self.peer.lock:
+            if self.peer.session is None:
+                self.peer.open_session(self.workers)
+        return self.peer.request_dataset(resource, time.time())
+
+    def hedged_dataset(self, resource, submitted=None):
+        """Get a dataset resource from this head, and from the peer head too
+        if this one fails or doesn't answer within hedge_delay. The first
+        answer is used, the other request is cancelled if it was not sent
+        yet, or its answer dropped."""
+        from concurrent.futures import wait, FIRST_COMPLETED
+        primary = self.hedges.submit(self.request_dataset, resource,
+                                     submitted)
+        wait([primary], timeout=min(self.hedge_delay(), time_left()))
+        if primary.done() and (primary.exception() is None or
+                               isinstance(primary.exception(),
+                                          DatasetMissing)):
+            return primary.result()
+        pending = set([primary,
+                       self.hedges.submit(self.peer_dataset, resource)])
+        while pending:
+            done, pending = wait(pending, timeout=time_left(),
+                                 return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    for other in pending:
+                        other.cancel()
+                    j = future.result()
+                    if future is not primary and resource in self.tiered:
+                        self.keep_sample(resource, j)
+                    return j
+        # both heads failed, report this head error
+        return primary.result()
+
+    def save_latency(self):
+        """Cache the recent response times of a cluster head"""
+        if self.peer is not None:
+            write_cache(self.name, "latency", list(self.latencies))
+
+    def storage_items(self, path, key, reduce):
+        """Get a storage list resource and return reduce(item) for every
+        item of its list key, parsed while the response is read so only the
+        reduced items are kept, and the request stats."""
+        started = time.time()
+        stats = {"retries": 0, "bytes": 0}
+        req, throttled = self.get(path, stats, stream=True)
+        started += throttled
+        kept = []
+
+        def chunks():
+            for chunk in req.iter_content(STREAMCHUNK):
+                stats["bytes"] += len(chunk)
+                if RECORDFILE:
+                    kept.append(chunk)
+                yield chunk
+        try:
+            if req.status_code == 404:
+                raise DatasetMissing(path)
+            content = chunks()
+            items = [reduce(item) for item in stream_items(content, key)]
+            # the end of the response, so the connection can be reused
+            for _ in content:
+                pass
+        finally:
+            req.close()
+            if RECORDFILE:
+                record_response(self.host, path, req.status_code,
+                                time.time() - started, b"".join(kept))
+        stats["response"] = time.time() - started
+        return items, stats
+
+    def storage_item(self, path, key, reduce):
+        """Get a storage resource and return reduce of its object key, and
+        the request stats."""
+        started = time.time()
+        stats = {"retries": 0, "bytes": 0}
+        req, throttled = self.get(path, stats)
+        started += throttled
+        content = req.content
         req.close()
-        for data in j.values():
-            channels.add_channel(channel_name="CPU Usage Percent",
-                                 value=data["data"]["value"],
-                                 is_float=False,
-                                 unit="Percent",
-                                 limit_max_warning=MAXWARNCPU,
-                                 limit_max_error=MAXERRORCPU,
-                                 is_limit_mode=1,
-                                 primary_channel=True)
+        if RECORDFILE:
+            record_response(self.host, path, req.status_code,
+                            time.time() - started, content)
+        if req.status_code == 404:
+            raise DatasetMissing(path)
+        stats["bytes"] = len(content)
+        stats["response"] = time.time() - started
+        return reduce(json_loads(content)[key]), stats
+
+    def capacity(self, workers):
+        """Return the capacity index of the appliance: the used and total
+        bytes of its pools and shares, and when the shares were walked. They
+        are walked every CAPACITYWALK seconds, in between only the pools and
+        the shares that can be reported are requested. Sensors of the same
+        appliance update the index one at a time, and use it as it is if
+        another one updated it while they waited."""
+        started = time.time()
+        stats = {"retries": 0, "bytes": 0, "start": started - STARTED}
+        self.stats["capacity"] = stats
+        try:
+            fd = os.open(cache_path("{}_capacity".format(self.name),
+                                    "flight"), os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                while not lock_file(fd, wait=False):
+                    if time_left() < FLIGHTPOLL:
+                        raise DeadlineExceeded()
+                    time.sleep(FLIGHTPOLL)
+                try:
+                    index = None
+                    if not RECORDFILE:
+                        index = read_cache(self.name, "capacity")
+                    if index is not None and index["updated"] >= started:
+                        stats["shared"] = time.time() - index["updated"]
+                        requests = []
+                    elif index is None or \
+                            index["walked"] + CAPACITYWALK <= started:
+                        index, requests = walk_capacity(self, workers)
+                        index["walked"] = started
+                    else:
+                        requests = refresh_capacity(self, index, workers)
+                    index["updated"] = time.time()
+                    write_cache(self.name, "capacity", index)
+                finally:
+                    unlock_file(fd)
+            finally:
+                os.close(fd)
+        except Exception as error:
+            stats["error"] = type(error).__name__
+            raise
+        for request in requests:
+            for field in ("bytes", "retries", "throttle"):
+                stats[field] = stats.get(field, 0) + request.get(field, 0)
+        stats["requests"] = len(requests)
+        stats["response"] = time.time() - started
+        stats["walked"] = time.time() - index["walked"]
+        return index
+
+    def prefetch(self, checks, workers):
+        """Send the dataset requests for checks at the same time, with at
+        most workers requests in flight to this appliance (and as many hedged
+        to the peer head of a cluster), and start the capacity collector."""
+        from concurrent.futures import ThreadPoolExecutor
+        pool = ThreadPoolExecutor(max_workers=workers)
+        if self.peer is not None and self.hedges is None:
+            # kept for the next runs, hedged requests are sent from it while
+            # the prefetch pool waits for them
+            self.hedges = ThreadPoolExecutor(max_workers=workers * 2)
+        for check in checks:
+            resource = RESOURCES[check]
+            if resource in self.cached:
+                continue
+            self.prefetched[resource] = pool.submit(
+                self.coalesced_dataset, resource, time.time())
+        pool.shutdown(wait=False)
+        if CAPACITY:
+            # the walk has its own WORKERS, it doesn't hold the datasets
+            walker = ThreadPoolExecutor(max_workers=1)
+            self.prefetched[POOLSRES] = walker.submit(self.capacity, WORKERS)
+            walker.shutdown(wait=False)
+
+
+###############################################################################
+# Appliances to check, and the one the check functions are running for.
+###############################################################################
+APPLIANCES = []
+APPLIANCE = None
+
+
+def dataset_name(resource):
+    """Return the dataset name of an analytics dataset resource, unquoting
+    the names built by dataset_check as they may have a slash."""
+    name = resource.split("/")[4]
+    if "%" in name:
+        from urllib.parse import unquote
+        name = unquote(name)
+    return name
+
+
+def window_resource(resource):
+    """Return resource asking for the last WINDOW seconds of the dataset
+    instead of the current second."""
+    if WINDOW == 1:
+        return resource
+    start = time.strftime(WINDOWSTART, time.gmtime(time.time() - WINDOW))
+    return resource.replace("start=now&seconds=1",
+                            WINDOWQUERY.format(start, WINDOW))
+
+
+###############################################################################
+# Values of a dataset response, one per sample, and for breakdown datasets the
+# (key, value) pairs of each sample.
+###############################################################################
+Dataset = namedtuple("Dataset", ["values", "breakdowns"])
+
+
+def extract(j, breakdown):
+    """Reduce a decoded dataset response to the fields the channels use, so
+    the decoded tree can be freed as soon as the request is done. Fields are
+    taken with itemgetter and map, without a python loop per sample."""
+    samples = j["data"]
+    if isinstance(samples, dict):
+        samples = [samples]
+    data = list(map(itemgetter("data"), samples))
+    values = list(map(itemgetter("value"), data))
+    if not breakdown:
+        return Dataset(values, None)
+    keyvalue = itemgetter("key", "value")
+    return Dataset(values,
+                   [list(map(keyvalue, d.get("data", ()))) for d in data])
+
+
+def nearest_rank(values, percentile):
+    """Return the percentile of sorted values, by nearest rank"""
+    return values[-(-len(values) * percentile // 100) - 1]
+
+
+def aggregate(values):
+    """Return average, max and 95th percentile of the sample values, reduced
+    with builtins so there is no python loop per sample."""
+    values = sorted(values)
+    p95 = nearest_rank(values, 95)
+    return int(round(sum(values) / float(len(values)))), values[-1], p95
+
+
+class History(object):
+    """Last HISTORYSIZE values of a channel, in a memory mapped cache file
+    used as a ring: a header with the count of values written and the time
+    of the last one, then the values as doubles."""
+
+    HEADER = "<Qd"
+
+    def __init__(self, name):
+        import mmap
+        import struct
+        self.header = struct.Struct(self.HEADER)
+        size = self.header.size + 8 * HISTORYSIZE
+        self.fd = os.open(cache_path(name, "ring"), os.O_RDWR | os.O_CREAT,
+                          0o600)
+        if os.fstat(self.fd).st_size != size:
+            # new, or made with another HISTORYSIZE
+            os.ftruncate(self.fd, 0)
+            os.ftruncate(self.fd, size)
+        self.map = mmap.mmap(self.fd, size)
+        self.values = memoryview(self.map)[self.header.size:].cast("d")
+
+    def append(self, value, now):
+        """Write value over the oldest one, unless the last one is less than
+        HISTORYSTEP seconds old (another sensor of the same appliance)."""
+        written, last = self.header.unpack_from(self.map, 0)
+        if now - last < HISTORYSTEP:
+            return
+        self.values[written % HISTORYSIZE] = value
+        self.header.pack_into(self.map, 0, written + 1, now)
+
+    def recent(self):
+        """Return the values in the ring, in ring order"""
+        written, _ = self.header.unpack_from(self.map, 0)
+        return self.values[:min(written, HISTORYSIZE)].tolist()
+
+    def close(self):
+        self.values.release()
+        self.map.close()
+        os.close(self.fd)
+
+
+def dynamic_limits(channel_name, value, kwargs):
+    """Return kwargs with the limits it has replaced by the ones of the
+    history of channel_name in the current appliance, computed from one sort
+    of it, and add value to the history. PRTG keeps the limits a channel was
+    created with, so the channel warning flag is set too when value is out
+    of the warning limits."""
+    history = History("{}_{}".format(APPLIANCE.host, channel_name))
+    try:
+        values = sorted(history.recent())
+        history.append(value, time.time())
+    finally:
+        history.close()
+    if len(values) < HISTORYMIN or not kwargs.get("is_limit_mode"):
+        return kwargs
+    kwargs = dict(kwargs)
+    integer = not kwargs.get("is_float")
+    low = (kwargs.get("limit_min_warning") is not None or
+           kwargs.get("limit_min_error") is not None)
+    for kind, (high, lowest, margin) in (("warning", DYNAMICWARNING),
+                                         ("error", DYNAMICERROR)):
+        name = "limit_{}_{}".format("min" if low else "max", kind)
+        if low:
+            limit = nearest_rank(values, lowest) / margin
+        else:
+            limit = max(nearest_rank(values, high) * margin,
+                        (kwargs.get(name) or 0) * DYNAMICFLOOR)
+        if integer:
+            limit = int(round(limit))
+        kwargs[name] = limit
+    if low and value < kwargs["limit_min_warning"] or \
+            not low and value > kwargs["limit_max_warning"]:
+        kwargs["warning"] = True
+    return kwargs
+
+
+def add_dataset_channels(j, channel_name, primary_channel=False, **kwargs):
+    """Add the value of a dataset as channel_name. For a multi-second window
+    the channel is the average, with max and p95 channels after it. With
+    --dynamic the limits of each channel come from its own history."""
+    if WINDOW == 1:
+        value = j.values[-1]
+    else:
+        value, maximum, p95 = aggregate(j.values)
+    limits = kwargs
+    if DYNAMIC:
+        limits = dynamic_limits(channel_name, value, kwargs)
+    channels.add_channel(channel_name=channel_name,
+                         value=value,
+                         primary_channel=primary_channel,
+                         **limits)
+    if WINDOW == 1:
+        return
+    for name, value in ((channel_name + " Max", maximum),
+                        (channel_name + " p95", p95)):
+        limits = kwargs
+        if DYNAMIC:
+            limits = dynamic_limits(name, value, kwargs)
+        channels.add_channel(channel_name=name, value=value, **limits)
+
+
+def breakdown_top(j):
+    """Return the TOPK (key, value) pairs with the highest values of a
+    breakdown dataset, selected with a bounded heap. For a multi-second window
+    the values are the average of each key over the window."""
+    if len(j.breakdowns) == 1:
+        return heapq.nlargest(TOPK, j.breakdowns[0], key=itemgetter(1))
+    totals = Counter()
+    for breakdown in j.breakdowns:
+        totals.update(dict(breakdown))
+    return [(key, int(round(total / float(len(j.breakdowns)))))
+            for key, total in totals.most_common(TOPK)]
+
+
+def add_breakdown_channels(j, channel_name, **kwargs):
+    """Add a channel for each of the top contributors of a breakdown dataset,
+    named channel_name and the contributor."""
+    channels.add_channels([("{} {}".format(channel_name, key), value)
+                           for key, value in breakdown_top(j)], **kwargs)
+
+
+def latency_percentiles(j):
+    """Return the LATENCYPERCENTILES and max latency in milliseconds of a
+    latency histogram dataset. The buckets of all the samples of the window
+    are sorted together, duplicated buckets don't need to be merged first,
+    and the percentiles are found in their cumulative counts with bisect, so
+    there is no python loop per bucket or sample."""
+    buckets = list(chain.from_iterable(j.breakdowns))
+    buckets = sorted(filter(itemgetter(1),
+                            zip(map(float, map(itemgetter(0), buckets)),
+                                map(itemgetter(1), buckets))))
+    if not buckets:
+        return [0.0] * (len(LATENCYPERCENTILES) + 1)
+    latencies, counts = zip(*buckets)
+    cumulative = list(accumulate(counts))
+    total = cumulative[-1]
+    ranks = [-(-total * p // 100) for p in LATENCYPERCENTILES]
+    return [latencies[bisect_left(cumulative, rank)] / 1000.0
+            for rank in ranks] + [latencies[-1] / 1000.0]
+
+
+def add_latency_channels(j, channel_name, **kwargs):
+    """Add channel_name p50, p95, p99 and Max channels for a latency
+    histogram dataset, in milliseconds."""
+    names = ["p{}".format(p) for p in LATENCYPERCENTILES] + ["Max"]
+    for name, value in zip(names, latency_percentiles(j)):
+        name = "{} {}".format(channel_name, name)
+        limits = kwargs
+        if DYNAMIC:
+            limits = dynamic_limits(name, value, kwargs)
+        channels.add_channel(channel_name=name, value=value, **limits)
+
+
+def get_dataset(resource):
+    """Return the dataset prefetched from the current appliance, its cached
+    sample if its refresh tier didn't expire, or request it now. Errors are
+    raised to the check function."""
+    from concurrent.futures import TimeoutError
+    if resource in APPLIANCE.cached:
+        return APPLIANCE.cached[resource]
+    future = APPLIANCE.prefetched.pop(resource, None)
+    if future is None:
+        return APPLIANCE.request_dataset(resource)
+    try:
+        # past the deadline only requests already answered are used
+        return future.result(timeout=max(0, DEADLINE - time.time()))
+    except TimeoutError:
+        future.cancel()
+        raise
+
+
+def cpu():
+    try:
+        j = get_dataset(CPURES)
+        add_dataset_channels(j, channel_name="CPU Usage Percent",
+                             is_float=False,
+                             unit="Percent",
+                             limit_max_warning=MAXWARNCPU,
+                             limit_max_error=MAXERRORCPU,
+                             is_limit_mode=1,
+                             primary_channel=True)
     except Exception:
         if channels.sensor_message == "OK":
             channels.sensor_message = "| can't check cpu |"
@@ -196,22 +1694,14 @@ def cpu():
 
 def nfs2():
     try:
-        req = requests.get(URL + NFS2RES,
-                           auth=ZAUTH,
-                           verify=False,
-                           headers=HEADER,
-                           timeout=TIMEOUT)
-        j = json.loads(req.text)
-        req.close()
-        for data in j.values():
-            channels.add_channel(channel_name="NFS2",
-                                 value=data["data"]["value"],
-                                 is_float=False,
-                                 unit="Custom",
-                                 limit_max_warning=MAXWARNNFS2,
-                                 limit_max_error=MAXERRORNFS2,
-                                 is_limit_mode=1,
-                                 custom_unit="Ops/sec")
+        j = get_dataset(NFS2RES)
+        add_dataset_channels(j, channel_name="NFS2",
+                             is_float=False,
+                             unit="Custom",
+                             limit_max_warning=MAXWARNNFS2,
+                             limit_max_error=MAXERRORNFS2,
+                             is_limit_mode=1,
+                             custom_unit="Ops/sec")
     except Exception:
         if channels.sensor_message == "OK":
             channels.sensor_message = "| can't check nfs2 |"
@@ -221,22 +1711,14 @@ def nfs2():
 
 def nfs3():
     try:
-        req = requests.get(URL + NFS3RES,
-                           auth=ZAUTH,
-                           verify=False,
-                           headers=HEADER,
-                           timeout=TIMEOUT)
-        j = json.loads(req.text)
-        req.close()
-        for data in j.values():
-            channels.add_channel(channel_name="NFS3",
-                                 value=data["data"]["value"],
-                                 is_float=False,
-                                 unit="Custom",
-                                 limit_max_warning=MAXWARNNFS3,
-                                 limit_max_error=MAXERRORNFS3,
-                                 is_limit_mode=1,
-                                 custom_unit="Ops/sec")
+        j = get_dataset(NFS3RES)
+        add_dataset_channels(j, channel_name="NFS3",
+                             is_float=False,
+                             unit="Custom",
+                             limit_max_warning=MAXWARNNFS3,
+                             limit_max_error=MAXERRORNFS3,
+                             is_limit_mode=1,
+                             custom_unit="Ops/sec")
     except Exception:
         if channels.sensor_message == "OK":
             channels.sensor_message = "| can't check nfs3 |"
@@ -246,22 +1728,14 @@ def nfs3():
 
 def nfs4():
     try:
-        req = requests.get(URL + NFS4RES,
-                           auth=ZAUTH,
-                           verify=False,
-                           headers=HEADER,
-                           timeout=TIMEOUT)
-        j = json.loads(req.text)
-        req.close()
-        for data in j.values():
-            channels.add_channel(channel_name="NFS4",
-                                 value=data["data"]["value"],
-                                 is_float=False,
-                                 unit="Custom",
-                                 limit_max_warning=MAXWARNNFS4,
-                                 limit_max_error=MAXERRORNFS4,
-                                 is_limit_mode=1,
-                                 custom_unit="Ops/sec")
+        j = get_dataset(NFS4RES)
+        add_dataset_channels(j, channel_name="NFS4",
+                             is_float=False,
+                             unit="Custom",
+                             limit_max_warning=MAXWARNNFS4,
+                             limit_max_error=MAXERRORNFS4,
+                             is_limit_mode=1,
+                             custom_unit="Ops/sec")
     except Exception:
         if channels.sensor_message == "OK":
             channels.sensor_message = "| can't check nfs4 |"
@@ -271,22 +1745,14 @@ def nfs4():
 
 def disk():
     try:
-        req = requests.get(URL + DISKRES,
-                           auth=ZAUTH,
-                           verify=False,
-                           headers=HEADER,
-                           timeout=TIMEOUT)
-        j = json.loads(req.text)
-        req.close()
-        for data in j.values():
-            channels.add_channel(channel_name="Disk",
-                                 value=data["data"]["value"],
-                                 is_float=False,
-                                 unit="Custom",
-                                 limit_max_warning=MAXWARNDISK,
-                                 limit_max_error=MAXERRORDISK,
-                                 is_limit_mode=1,
-                                 custom_unit="Ops/sec")
+        j = get_dataset(DISKRES)
+        add_dataset_channels(j, channel_name="Disk",
+                             is_float=False,
+                             unit="Custom",
+                             limit_max_warning=MAXWARNDISK,
+                             limit_max_error=MAXERRORDISK,
+                             is_limit_mode=1,
+                             custom_unit="Ops/sec")
     except Exception:
         if channels.sensor_message == "OK":
             channels.sensor_message = "| can't check disk |"
@@ -296,22 +1762,14 @@ def disk():
 
 def fc():
     try:
-        req = requests.get(URL + FCRES,
-                           auth=ZAUTH,
-                           verify=False,
-                           headers=HEADER,
-                           timeout=TIMEOUT)
-        j = json.loads(req.text)
-        req.close()
-        for data in j.values():
-            channels.add_channel(channel_name="FC",
-                                 value=data["data"]["value"],
-                                 is_float=False,
-                                 unit="Custom",
-                                 limit_max_warning=MAXWARNFC,
-                                 limit_max_error=MAXERRORFC,
-                                 is_limit_mode=1,
-                                 custom_unit="Ops/sec")
+        j = get_dataset(FCRES)
+        add_dataset_channels(j, channel_name="FC",
+                             is_float=False,
+                             unit="Custom",
+                             limit_max_warning=MAXWARNFC,
+                             limit_max_error=MAXERRORFC,
+                             is_limit_mode=1,
+                             custom_unit="Ops/sec")
     except Exception:
         if channels.sensor_message == "OK":
             channels.sensor_message = "| can't check fc |"
@@ -321,22 +1779,14 @@ def fc():
 
 def iscsi():
     try:
-        req = requests.get(URL + ISCSIRES,
-                           auth=ZAUTH,
-                           verify=False,
-                           headers=HEADER,
-                           timeout=TIMEOUT)
-        j = json.loads(req.text)
-        req.close()
-        for data in j.values():
-            channels.add_channel(channel_name="ISCSI",
-                                 value=data["data"]["value"],
-                                 is_float=False,
-                                 unit="Custom",
-                                 limit_max_warning=MAXWARNISCSI,
-                                 limit_max_error=MAXERRORISCSI,
-                                 is_limit_mode=1,
-                                 custom_unit="Ops/sec")
+        j = get_dataset(ISCSIRES)
+        add_dataset_channels(j, channel_name="ISCSI",
+                             is_float=False,
+                             unit="Custom",
+                             limit_max_warning=MAXWARNISCSI,
+                             limit_max_error=MAXERRORISCSI,
+                             is_limit_mode=1,
+                             custom_unit="Ops/sec")
     except Exception:
         if channels.sensor_message == "OK":
             channels.sensor_message = "| can't check iscsi |"
@@ -346,22 +1796,14 @@ def iscsi():
 
 def smb():
     try:
-        req = requests.get(URL + SMBRES,
-                           auth=ZAUTH,
-                           verify=False,
-                           headers=HEADER,
-                           timeout=TIMEOUT)
-        j = json.loads(req.text)
-        req.close()
-        for data in j.values():
-            channels.add_channel(channel_name="SMB",
-                                 value=data["data"]["value"],
-                                 is_float=False,
-                                 unit="Custom",
-                                 limit_max_warning=MAXWARNSMB,
-                                 limit_max_error=MAXERRORSMB,
-                                 is_limit_mode=1,
-                                 custom_unit="Ops/sec")
+        j = get_dataset(SMBRES)
+        add_dataset_channels(j, channel_name="SMB",
+                             is_float=False,
+                             unit="Custom",
+                             limit_max_warning=MAXWARNSMB,
+                             limit_max_error=MAXERRORSMB,
+                             is_limit_mode=1,
+                             custom_unit="Ops/sec")
     except Exception:
         if channels.sensor_message == "OK":
             channels.sensor_message = "| can't check smb |"
@@ -371,22 +1813,14 @@ def smb():
 
 def smb2():
     try:
-        req = requests.get(URL + SMB2RES,
-                           auth=ZAUTH,
-                           verify=False,
-                           headers=HEADER,
-                           timeout=TIMEOUT)
-        j = json.loads(req.text)
-        req.close()
-        for data in j.values():
-            channels.add_channel(channel_name="SMB2",
-                                 value=data["data"]["value"],
-                                 is_float=False,
-                                 unit="Custom",
-                                 limit_max_warning=MAXWARNSMB2,
-                                 limit_max_error=MAXERRORSMB2,
-                                 is_limit_mode=1,
-                                 custom_unit="Ops/sec")
+        j = get_dataset(SMB2RES)
+        add_dataset_channels(j, channel_name="SMB2",
+                             is_float=False,
+                             unit="Custom",
+                             limit_max_warning=MAXWARNSMB2,
+                             limit_max_error=MAXERRORSMB2,
+                             is_limit_mode=1,
+                             custom_unit="Ops/sec")
     except Exception:
         if channels.sensor_message == "OK":
             channels.sensor_message = "| can't check smb2 |"
@@ -396,22 +1830,14 @@ def smb2():
 
 def smb3():
     try:
-        req = requests.get(URL + SMB3RES,
-                           auth=ZAUTH,
-                           verify=False,
-                           headers=HEADER,
-                           timeout=TIMEOUT)
-        j = json.loads(req.text)
-        req.close()
-        for data in j.values():
-            channels.add_channel(channel_name="SMB3",
-                                 value=data["data"]["value"],
-                                 is_float=False,
-                                 unit="Custom",
-                                 limit_max_warning=MAXWARNSMB3,
-                                 limit_max_error=MAXERRORSMB3,
-                                 is_limit_mode=1,
-                                 custom_unit="Ops/sec")
+        j = get_dataset(SMB3RES)
+        add_dataset_channels(j, channel_name="SMB3",
+                             is_float=False,
+                             unit="Custom",
+                             limit_max_warning=MAXWARNSMB3,
+                             limit_max_error=MAXERRORSMB3,
+                             is_limit_mode=1,
+                             custom_unit="Ops/sec")
     except Exception:
         if channels.sensor_message == "OK":
             channels.sensor_message = "| can't check smb3 |"
@@ -421,22 +1847,14 @@ def smb3():
 
 def nic():
     try:
-        req = requests.get(URL + NICRES,
-                           auth=ZAUTH,
-                           verify=False,
-                           headers=HEADER,
-                           timeout=TIMEOUT)
-        j = json.loads(req.text)
-        req.close()
-        for data in j.values():
-            channels.add_channel(channel_name="NIC",
-                                 value=data["data"]["value"],
-                                 is_float=False,
-                                 unit="Custom",
-                                 limit_max_warning=MAXWARNNIC,
-                                 limit_max_error=MAXERRORNIC,
-                                 is_limit_mode=1,
-                                 custom_unit="Kilobytes/sec")
+        j = get_dataset(NICRES)
+        add_dataset_channels(j, channel_name="NIC",
+                             is_float=False,
+                             unit="Custom",
+                             limit_max_warning=MAXWARNNIC,
+                             limit_max_error=MAXERRORNIC,
+                             is_limit_mode=1,
+                             custom_unit="Kilobytes/sec")
     except Exception:
         if channels.sensor_message == "OK":
             channels.sensor_message = "| can't check nic |"
@@ -446,21 +1864,13 @@ def nic():
 
 def arc():
     try:
-        req = requests.get(URL + ARCRES,
-                           auth=ZAUTH,
-                           verify=False,
-                           headers=HEADER,
-                           timeout=TIMEOUT)
-        j = json.loads(req.text)
-        req.close()
-        for data in j.values():
-            channels.add_channel(channel_name="ARC Hit radio",
-                                 value=data["data"]["value"],
-                                 is_float=False,
-                                 limit_min_warning=MINWARNARC,
-                                 limit_min_error=MINERRORARC,
-                                 is_limit_mode=1,
-                                 unit="Percent")
+        j = get_dataset(ARCRES)
+        add_dataset_channels(j, channel_name="ARC Hit radio",
+                             is_float=False,
+                             limit_min_warning=MINWARNARC,
+                             limit_min_error=MINERRORARC,
+                             is_limit_mode=1,
+                             unit="Percent")
     except Exception:
         if channels.sensor_message == "OK":
             channels.sensor_message = "| can't check ARC |"
@@ -470,22 +1880,14 @@ def arc():
 
 def http():
     try:
-        req = requests.get(URL + HTTPRES,
-                           auth=ZAUTH,
-                           verify=False,
-                           headers=HEADER,
-                           timeout=TIMEOUT)
-        j = json.loads(req.text)
-        req.close()
-        for data in j.values():
-            channels.add_channel(channel_name="HTTP",
-                                 value=data["data"]["value"],
-                                 is_float=False,
-                                 limit_max_warning=MAXWARNHTTP,
-                                 limit_max_error=MAXERRORHTTP,
-                                 is_limit_mode=1,
-                                 unit="Custom",
-                                 custom_unit="Request/sec")
+        j = get_dataset(HTTPRES)
+        add_dataset_channels(j, channel_name="HTTP",
+                             is_float=False,
+                             limit_max_warning=MAXWARNHTTP,
+                             limit_max_error=MAXERRORHTTP,
+                             is_limit_mode=1,
+                             unit="Custom",
+                             custom_unit="Request/sec")
     except Exception:
         if channels.sensor_message == "OK":
             channels.sensor_message = "| can't check HTTP |"
@@ -495,22 +1897,14 @@ def http():
 
 def sftp():
     try:
-        req = requests.get(URL + SFTPRES,
-                           auth=ZAUTH,
-                           verify=False,
-                           headers=HEADER,
-                           timeout=TIMEOUT)
-        j = json.loads(req.text)
-        req.close()
-        for data in j.values():
-            channels.add_channel(channel_name="SFTP",
-                                 value=data["data"]["value"],
-                                 is_float=False,
-                                 limit_max_warning=MAXWARNSFTP,
-                                 limit_max_error=MAXERRORSFTP,
-                                 is_limit_mode=1,
-                                 unit="Custom",
-                                 custom_unit="Kilobytes/sec")
+        j = get_dataset(SFTPRES)
+        add_dataset_channels(j, channel_name="SFTP",
+                             is_float=False,
+                             limit_max_warning=MAXWARNSFTP,
+                             limit_max_error=MAXERRORSFTP,
+                             is_limit_mode=1,
+                             unit="Custom",
+                             custom_unit="Kilobytes/sec")
     except Exception:
         if channels.sensor_message == "OK":
             channels.sensor_message = "| can't check SFTP |"
@@ -520,22 +1914,14 @@ def sftp():
 
 def ftp():
     try:
-        req = requests.get(URL + FTPRES,
-                           auth=ZAUTH,
-                           verify=False,
-                           headers=HEADER,
-                           timeout=TIMEOUT)
-        j = json.loads(req.text)
-        req.close()
-        for data in j.values():
-            channels.add_channel(channel_name="FTP",
-                                 value=data["data"]["value"],
-                                 is_float=False,
-                                 limit_max_warning=MAXWARNFTP,
-                                 limit_max_error=MAXERRORFTP,
-                                 is_limit_mode=1,
-                                 unit="Custom",
-                                 custom_unit="Kilobytes/sec")
+        j = get_dataset(FTPRES)
+        add_dataset_channels(j, channel_name="FTP",
+                             is_float=False,
+                             limit_max_warning=MAXWARNFTP,
+                             limit_max_error=MAXERRORFTP,
+                             is_limit_mode=1,
+                             unit="Custom",
+                             custom_unit="Kilobytes/sec")
     except Exception:
         if channels.sensor_message == "OK":
             channels.sensor_message = "| can't check FTP |"
@@ -543,52 +1929,974 @@ def ftp():
             channels.sensor_message += "| can't check FTP |"
 
 
+def nfs3client():
+    try:
+        j = get_dataset(NFS3CLIENTRES)
+        add_breakdown_channels(j, channel_name="NFS3",
+                               is_float=False,
+                               unit="Custom",
+                               limit_max_warning=MAXWARNNFS3,
+                               limit_max_error=MAXERRORNFS3,
+                               is_limit_mode=1,
+                               custom_unit="Ops/sec")
+    except Exception:
+        if channels.sensor_message == "OK":
+            channels.sensor_message = "| can't check nfs3client |"
+        else:
+            channels.sensor_message += "| can't check nfs3client |"
+
+
+def nfs4client():
+    try:
+        j = get_dataset(NFS4CLIENTRES)
+        add_breakdown_channels(j, channel_name="NFS4",
+                               is_float=False,
+                               unit="Custom",
+                               limit_max_warning=MAXWARNNFS4,
+                               limit_max_error=MAXERRORNFS4,
+                               is_limit_mode=1,
+                               custom_unit="Ops/sec")
+    except Exception:
+        if channels.sensor_message == "OK":
+            channels.sensor_message = "| can't check nfs4client |"
+        else:
+            channels.sensor_message += "| can't check nfs4client |"
+
+
+def iscsilun():
+    try:
+        j = get_dataset(ISCSILUNRES)
+        add_breakdown_channels(j, channel_name="ISCSI",
+                               is_float=False,
+                               unit="Custom",
+                               limit_max_warning=MAXWARNISCSI,
+                               limit_max_error=MAXERRORISCSI,
+                               is_limit_mode=1,
+                               custom_unit="Ops/sec")
+    except Exception:
+        if channels.sensor_message == "OK":
+            channels.sensor_message = "| can't check iscsilun |"
+        else:
+            channels.sensor_message += "| can't check iscsilun |"
+
+
+def diskio():
+    try:
+        j = get_dataset(DISKIORES)
+        add_breakdown_channels(j, channel_name="Disk",
+                               is_float=False,
+                               unit="Custom",
+                               limit_max_warning=MAXWARNDISK,
+                               limit_max_error=MAXERRORDISK,
+                               is_limit_mode=1,
+                               custom_unit="Ops/sec")
+    except Exception:
+        if channels.sensor_message == "OK":
+            channels.sensor_message = "| can't check diskio |"
+        else:
+            channels.sensor_message += "| can't check diskio |"
+
+
 ###############################################################################
 # Default list of enabled checks to run
 ###############################################################################
-ENABLEDCHECKS = {
-    "cpu": cpu,
-    "nfs2": nfs2,
-    "nfs3": nfs3,
-    "nfs4": nfs4,
-    "disk": disk,
-    "fc": fc,
-    "iscsi": iscsi,
-    "smb": smb,
-    "smb2": smb2,
-    "smb3": smb3,
-    "nic": nic,
-    "arc": arc,
-    "http": http,
-    "sftp": sftp,
-    "ftp": ftp
-}
+ENABLEDCHECKS = OrderedDict([
+    ("cpu", cpu),
+    ("nfs2", nfs2),
+    ("nfs3", nfs3),
+    ("nfs4", nfs4),
+    ("disk", disk),
+    ("fc", fc),
+    ("iscsi", iscsi),
+    ("smb", smb),
+    ("smb2", smb2),
+    ("smb3", smb3),
+    ("nic", nic),
+    ("arc", arc),
+    ("http", http),
+    ("sftp", sftp),
+    ("ftp", ftp)
+])
+
+###############################################################################
+# Breakdown checks, only run when included
+###############################################################################
+BREAKDOWNCHECKS = OrderedDict([
+    ("nfs3client", nfs3client),
+    ("nfs4client", nfs4client),
+    ("iscsilun", iscsilun),
+    ("diskio", diskio)
+])
+
+
+###############################################################################
+# Latency histogram checks, only run when included
+###############################################################################
+def nfs3latency():
+    try:
+        j = get_dataset(NFS3LATENCYRES)
+        add_latency_channels(j, channel_name="NFS3 Latency",
+                             is_float=True,
+                             unit="TimeResponse",
+                             limit_max_warning=MAXWARNNFS3LATENCY,
+                             limit_max_error=MAXERRORNFS3LATENCY,
+                             is_limit_mode=1)
+    except Exception:
+        if channels.sensor_message == "OK":
+            channels.sensor_message = "| can't check nfs3latency |"
+        else:
+            channels.sensor_message += "| can't check nfs3latency |"
+
+
+def nfs4latency():
+    try:
+        j = get_dataset(NFS4LATENCYRES)
+        add_latency_channels(j, channel_name="NFS4 Latency",
+                             is_float=True,
+                             unit="TimeResponse",
+                             limit_max_warning=MAXWARNNFS4LATENCY,
+                             limit_max_error=MAXERRORNFS4LATENCY,
+                             is_limit_mode=1)
+    except Exception:
+        if channels.sensor_message == "OK":
+            channels.sensor_message = "| can't check nfs4latency |"
+        else:
+            channels.sensor_message += "| can't check nfs4latency |"
+
+
+def iscsilatency():
+    try:
+        j = get_dataset(ISCSILATENCYRES)
+        add_latency_channels(j, channel_name="iSCSI Latency",
+                             is_float=True,
+                             unit="TimeResponse",
+                             limit_max_warning=MAXWARNISCSILATENCY,
+                             limit_max_error=MAXERRORISCSILATENCY,
+                             is_limit_mode=1)
+    except Exception:
+        if channels.sensor_message == "OK":
+            channels.sensor_message = "| can't check iscsilatency |"
+        else:
+            channels.sensor_message += "| can't check iscsilatency |"
+
+
+LATENCYCHECKS = OrderedDict([
+    ("nfs3latency", nfs3latency),
+    ("nfs4latency", nfs4latency),
+    ("iscsilatency", iscsilatency)
+])
+
+###############################################################################
+# Dataset resource requested by each check
+###############################################################################
+RESOURCES = OrderedDict([
+    ("cpu", CPURES),
+    ("nfs2", NFS2RES),
+    ("nfs3", NFS3RES),
+    ("nfs4", NFS4RES),
+    ("disk", DISKRES),
+    ("fc", FCRES),
+    ("iscsi", ISCSIRES),
+    ("smb", SMBRES),
+    ("smb2", SMB2RES),
+    ("smb3", SMB3RES),
+    ("nic", NICRES),
+    ("arc", ARCRES),
+    ("http", HTTPRES),
+    ("sftp", SFTPRES),
+    ("ftp", FTPRES),
+    ("nfs3client", NFS3CLIENTRES),
+    ("nfs4client", NFS4CLIENTRES),
+    ("iscsilun", ISCSILUNRES),
+    ("diskio", DISKIORES),
+    ("nfs3latency", NFS3LATENCYRES),
+    ("nfs4latency", NFS4LATENCYRES),
+    ("iscsilatency", ISCSILATENCYRES)
+])
+
+
+###############################################################################
+# Capacity collector: pools, projects and shares of the storage API, walked
+# concurrently into an index of the usage of every share kept in the cache
+# directory. Only the pools, the top consumers and the fullest shares become
+# channels.
+###############################################################################
+def pool_usage(pool):
+    """Return the used and total bytes of a pool"""
+    usage = pool["usage"]
+    return [int(usage["used"]), int(usage["used"] + usage["available"])]
+
+
+def share_usage(kind, share):
+    """Return the name, used and total bytes of a filesystem or lun. The
+    total of a filesystem is its quota, or what it uses plus the space still
+    available to it."""
+    used = share.get("space_total", 0)
+    if kind == "luns":
+        total = share.get("volsize", 0)
+    else:
+        total = share.get("quota") or used + share.get("space_available", 0)
+    return share["name"], int(used), int(total)
+
+
+def used_percent(used, total):
+    """Return used as a percent of total"""
+    return round(100.0 * used / total, 1) if total else 0.0
+
+
+def top_consumers(shares):
+    """Return the TOPK shares of a capacity index using the most space"""
+    return heapq.nlargest(TOPK, shares, key=lambda share: shares[share][0])
+
+
+def fullest(shares, percent):
+    """Return the shares of a capacity index at or above percent used, the
+    fullest first"""
+    full = [(used_percent(*usage), share) for share, usage in shares.items()
+            if usage[0] >= usage[1] * percent / 100.0]
+    return [share for _, share in sorted(full, reverse=True)]
+
+
+def walk_capacity(appliance, workers):
+    """Walk the pools, projects and shares of appliance with up to workers
+    requests in flight. The projects of a pool are listed as soon as the
+    pool is, and the shares of a project as soon as the project is, so
+    there is no wait between levels. A pool, project or share list that
+    can't be read is skipped, and kept in the index as skipped until the
+    next walk. Return the capacity index and the request stats."""
+    from urllib.parse import quote
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+    executor = ThreadPoolExecutor(max_workers=workers)
+    index = {"pools": {}, "shares": {}, "skipped": []}
+    requests = []
+    pending = {executor.submit(appliance.storage_items, POOLSRES, "pools",
+                               itemgetter("name")): ("pools",)}
+    try:
+        while pending:
+            done, _ = wait(pending, timeout=time_left(),
+                           return_when=FIRST_COMPLETED)
+            for future in done:
+                level = pending.pop(future)
+                try:
+                    items, stats = future.result()
+                except DatasetMissing:
+                    # destroyed while walking
+                    continue
+                except DeadlineExceeded:
+                    raise
+                except Exception:
+                    if level[0] == "pools":
+                        raise
+                    # keep walking the rest, the next walk tries it again
+                    index["skipped"].append("/".join(level[1:]))
+                    continue
+                requests.append(stats)
+                if level[0] == "pools":
+                    for pool in items:
+                        path = POOLRES.format(quote(pool, safe=""))
+                        pending[executor.submit(
+                            appliance.storage_item, path, "pool",
+                            pool_usage)] = ("pool", pool)
+                        pending[executor.submit(
+                            appliance.storage_items,
+                            PROJECTSRES.format(quote(pool, safe="")),
+                            "projects", itemgetter("name"))] = ("projects",
+                                                                pool)
+                elif level[0] == "pool":
+                    index["pools"][level[1]] = items
+                elif level[0] == "projects":
+                    for project in items:
+                        for kind in SHAREKINDS:
+                            path = SHARESRES.format(
+                                quote(level[1], safe=""),
+                                quote(project, safe=""), kind)
+                            pending[executor.submit(
+                                appliance.storage_items, path, kind,
+                                partial(share_usage, kind))] = (
+                                    "shares", level[1], project, kind)
+                else:
+                    prefix = "/".join(level[1:]) + "/"
+                    for name, used, total in items:
+                        index["shares"][prefix + name] = [used, total]
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
+    return index, requests
+
+
+def refresh_capacity(appliance, index, workers):
+    """Request again the pools of a capacity index and the shares that can
+    be reported: the top consumers and the fullest ones, down to
+    CAPACITYMARGIN points under the capacity percent. Shares destroyed since
+    the walk are removed. Return the request stats."""
+    from urllib.parse import quote
+    from concurrent.futures import ThreadPoolExecutor, wait
+    shares = index["shares"]
+    watched = set(top_consumers(shares))
+    watched.update(fullest(shares, CAPACITY - CAPACITYMARGIN)[:CAPACITYMAX])
+    executor = ThreadPoolExecutor(max_workers=workers)
+    pending = {}
+    for pool in index["pools"]:
+        pending[executor.submit(appliance.storage_item,
+                                POOLRES.format(quote(pool, safe="")), "pool",
+                                pool_usage)] = ("pools", pool)
+    for share in watched:
+        pool, project, kind, name = share.split("/")
+        path = SHARERES.format(quote(pool, safe=""), quote(project, safe=""),
+                               kind, quote(name, safe=""))
+        pending[executor.submit(appliance.storage_item, path, kind[:-1],
+                                partial(share_usage, kind))] = ("shares",
+                                                                share)
+    executor.shutdown(wait=False)
+    done, late = wait(pending, timeout=time_left())
+    for future in late:
+        future.cancel()
+    if late:
+        raise DeadlineExceeded()
+    requests = []
+    for future in done:
+        level, name = pending[future]
+        try:
+            usage, stats = future.result()
+        except DatasetMissing:
+            index[level].pop(name, None)
+            continue
+        requests.append(stats)
+        index[level][name] = usage if level == "pools" else list(usage[1:])
+    return requests
+
+
+def share_name(share):
+    """Return the channel name of a share of a capacity index, without its
+    kind"""
+    pool, project, _, name = share.split("/")
+    return "{}/{}/{}".format(pool, project, name)
+
+
+def add_capacity_channels():
+    """Add the capacity channels of the current appliance: the percent used
+    of every pool, the bytes used by the TOPK top consumers, the percent
+    used of up to CAPACITYMAX shares at or above the capacity percent, and
+    the count of all of them. If the index can't be updated, its last
+    version is used. Parts of the storage skipped by the last walk are
+    listed in the sensor message."""
+    from concurrent.futures import TimeoutError
+    future = APPLIANCE.prefetched.pop(POOLSRES, None)
+    try:
+        if future is None:
+            index = APPLIANCE.capacity(WORKERS)
+        else:
+            index = future.result(timeout=max(0, DEADLINE - time.time()))
+    except Exception as error:
+        if isinstance(error, TimeoutError):
+            future.cancel()
+        index = read_cache(APPLIANCE.name, "capacity")
+        if channels.sensor_message == "OK":
+            channels.sensor_message = "| can't check capacity |"
+        else:
+            channels.sensor_message += "| can't check capacity |"
+        if index is None:
+            return
+    skipped = sorted(set(index.get("skipped", [])))
+    if skipped:
+        message = "| capacity not walked: {} |".format(", ".join(skipped))
+        if channels.sensor_message == "OK":
+            channels.sensor_message = message
+        else:
+            channels.sensor_message += message
+    limits = {"is_limit_mode": 1, "limit_max_warning": CAPACITY,
+              "limit_max_error": max(CAPACITY, MAXERRORCAPACITY)}
+    channels.add_channels([("Pool {} Used".format(pool), used_percent(*usage))
+                           for pool, usage in sorted(index["pools"].items())],
+                          is_float=True, unit="Percent", **limits)
+    shares = index["shares"]
+    channels.add_channels([("Share {} Used".format(share_name(share)),
+                            shares[share][0])
+                           for share in top_consumers(shares)],
+                          is_float=False, unit="BytesDisk")
+    full = fullest(shares, CAPACITY)
+    channels.add_channels([("Share {} Used Percent".format(share_name(share)),
+                            used_percent(*shares[share]))
+                           for share in full[:CAPACITYMAX]],
+                          is_float=True, unit="Percent", **limits)
+    channels.add_channel(channel_name="Shares Over Capacity",
+                         value=len(full),
+                         unit="Count")
+
+
+###############################################################################
+# Checks for datasets found with --discover, by name
+###############################################################################
+DISCOVEREDCHECKS = OrderedDict()
+
+
+def check_function(check):
+    """Return the function of a check"""
+    for checks in (ENABLEDCHECKS, BREAKDOWNCHECKS, LATENCYCHECKS,
+                   DISCOVEREDCHECKS):
+        if check in checks:
+            return checks[check]
+    raise KeyError(check)
+
+
+def dataset_check(dataset):
+    """Return a check function for a discovered dataset without its own
+    check, with a channel named as the dataset (or its top contributors for
+    breakdown datasets, or its latency percentiles for latency histograms)
+    and the unit its name tells."""
+    from urllib.parse import quote
+    resource = DATASETRES.format(quote(dataset, safe=""))
+    kwargs = {"unit": "Custom", "is_float": False}
+    latency = dataset.endswith("[latency]")
+    if latency:
+        kwargs = {"unit": "TimeResponse", "is_float": True}
+    for suffix, unit, custom_unit in DATASETUNITS:
+        if not latency and dataset.split("[")[0].endswith(suffix):
+            kwargs.update(unit=unit, custom_unit=custom_unit)
+            break
+
+    def check():
+        try:
+            j = get_dataset(resource)
+            if latency:
+                add_latency_channels(j, channel_name=dataset, **kwargs)
+            elif "[" in dataset:
+                add_breakdown_channels(j, channel_name=dataset, **kwargs)
+            else:
+                add_dataset_channels(j, channel_name=dataset, **kwargs)
+        except Exception:
+            message = "| can't check {} |".format(dataset)
+            if channels.sensor_message == "OK":
+                channels.sensor_message = message
+            else:
+                channels.sensor_message += message
+    RESOURCES[dataset] = resource
+    return check
+
+
+def discover_checks():
+    """Return the checks for the active datasets of all the appliances: the
+    checks of known datasets in their usual order, then a check named as the
+    dataset for the others. Appliances whose datasets can't be listed get
+    the default checks. Include and exclude parameters filter them by
+    name."""
+    found = set()
+    for appliance in APPLIANCES:
+        datasets = appliance.discover()
+        if datasets is None:
+            datasets = [dataset_name(RESOURCES[c]) for c in ENABLEDCHECKS]
+        found.update(datasets)
+    known = dict((dataset_name(resource), check)
+                 for check, resource in RESOURCES.items())
+    checks = [check for check, resource in RESOURCES.items()
+              if check in known.values() and dataset_name(resource) in found]
+    for dataset in sorted(found.difference(known)):
+        if dataset not in DISCOVEREDCHECKS:
+            DISCOVEREDCHECKS[dataset] = dataset_check(dataset)
+        checks.append(dataset)
+    if INCLUDECHECKS:
+        checks = [check for check in checks if check in INCLUDECHECKS]
+    return [check for check in checks if check not in EXCLUDECHECKS]
+
+
+def read_inventory(path):
+    """Return the appliances listed in an inventory file, one per line as
+    <host> or <host> <username> <password>. Empty lines and lines starting
+    with # are ignored."""
+    appliances = []
+    with open(path) as inventory:
+        for line in inventory:
+            fields = line.split()
+            if not fields or fields[0].startswith("#"):
+                continue
+            if len(fields) >= 3:
+                appliances.append(Appliance(fields[0], fields[1], fields[2]))
+            else:
+                appliances.append(Appliance(fields[0]))
+    return appliances
+
+
+def result_name():
+    """Return the cache name for the result of all appliances with the
+    selected checks and options, so daemons of the same appliance with
+    other options don't overwrite it and a --cached sensor only reads the
+    result of a daemon started with its own options."""
+    import hashlib
+    names = [appliance.name for appliance in APPLIANCES]
+    options = [sorted(INCLUDECHECKS), sorted(EXCLUDECHECKS), DISCOVER, WINDOW,
+               TOPK, SELFMETRICS, CAPACITY, DYNAMIC, sorted(REFRESH.items())]
+    key = json.dumps([names, options]).encode()
+    return "{}_{}".format(names[0] if len(names) == 1 else "fleet",
+                          hashlib.sha1(key).hexdigest()[:12])
+
+
+def appliance_label(appliance):
+    """Return the host of an appliance, or host/user when other appliances
+    of the sensor have the same host, to name its channels."""
+    if sum(other.host == appliance.host for other in APPLIANCES) > 1:
+        return "{}/{}".format(appliance.host, appliance.auth[0])
+    return appliance.host
+
+
+def merge_result(result, host, checked):
+    """Add the channels and messages of one appliance to result, prefixing
+    them with host when there are several appliances."""
+    if len(APPLIANCES) == 1:
+        result.channels.extend(checked.channels)
+        result.sensor_message = checked.sensor_message
+        return
+    for name, value, template in checked.channels:
+        result.channels.append(("{} {}".format(host, name), value,
+                                template))
+    if checked.sensor_message != "OK":
+        message = "{}: {}".format(host, checked.sensor_message)
+        if result.sensor_message == "OK":
+            result.sensor_message = message
+        else:
+            result.sensor_message += " " + message
+
+
+def add_self_channels(appliance, checks):
+    """Add the collector channels for the request stats of an appliance: the
+    request time of every dataset, or the age of its cached sample, in the
+    checks order, and the bytes, retries, parse time and cached samples of
+    all of them. For a cluster, the requests hedged to the peer head too."""
+    stats = appliance.stats
+    hedged = []
+    if appliance.peer is not None:
+        hedged = [r for d, r in appliance.peer.stats.items() if d != "login"]
+    for check in checks:
+        request = stats.get(dataset_name(RESOURCES[check]), {})
+        if "response" in request:
+            channels.add_channel(
+                channel_name="{} Request Time".format(check),
+                value=int(request["response"] * 1000),
+                unit="TimeResponse")
+        elif "age" in request:
+            channels.add_channel(
+                channel_name="{} Sample Age".format(check),
+                value=int(request["age"]),
+                unit="TimeSeconds")
+    capacity = stats.get("capacity", {})
+    if "response" in capacity:
+        channels.add_channel(channel_name="capacity Request Time",
+                             value=int(capacity["response"] * 1000),
+                             unit="TimeResponse")
+        channels.add_channel(channel_name="capacity Walk Age",
+                             value=int(capacity["walked"]),
+                             unit="TimeSeconds")
+    done = list(stats.values()) + hedged
+    channels.add_channel(channel_name="Collector Bytes Received",
+                         value=sum(r["bytes"] for r in done),
+                         unit="BytesFile")
+    channels.add_channel(channel_name="Collector Retries",
+                         value=sum(r["retries"] for r in done),
+                         unit="Count")
+    channels.add_channel(
+        channel_name="Collector Parse Time",
+        value=int(sum(r.get("parse", 0) for r in done) * 1000),
+        unit="TimeResponse")
+    if COALESCETTL:
+        channels.add_channel(channel_name="Collector Shared Datasets",
+                             value=sum(1 for r in done if "shared" in r),
+                             unit="Count")
+    if RATELIMIT:
+        channels.add_channel(
+            channel_name="Collector Throttle Time",
+            value=int(sum(r.get("throttle", 0) for r in done) * 1000),
+            unit="TimeResponse")
+    channels.add_channel(channel_name="Collector Cached Samples",
+                         value=sum(1 for r in done if "age" in r),
+                         unit="Count")
+    if appliance.peer is not None:
+        channels.add_channel(channel_name="Collector Hedged Requests",
+                             value=len(hedged),
+                             unit="Count")
+
+
+def write_trace(started):
+    """Append the timings of every request of the run started at started to
+    TRACEFILE, one json object per line, and the run total time."""
+    try:
+        with open(TRACEFILE, "a") as trace:
+            heads = APPLIANCES + [a.peer for a in APPLIANCES
+                                  if a.peer is not None]
+            for appliance in heads:
+                for dataset, stats in sorted(appliance.stats.items()):
+                    line = dict(stats, time=started, host=appliance.host,
+                                dataset=dataset)
+                    trace.write(json.dumps(line) + "\n")
+            trace.write(json.dumps({"time": started, "dataset": "run",
+                                    "imports": IMPORTED - STARTED,
+                                    "total": time.time() - started}) + "\n")
+    except Exception:
+        pass
+
+
+###############################################################################
+# Exporters: the channels of every collection as a sample set, for consumers
+# other than PRTG fed from the same poll.
+###############################################################################
+Sample = namedtuple("Sample", ["host", "channel", "value", "unit"])
+SAMPLES = []
+# prometheus text of the last collection, served with --listen
+EXPOSITION = [""]
+PROMMETRIC = "zfssa_channel_value"
+INFLUXMEASUREMENT = "zfssa"
+# bytes of line protocol sent in one udp datagram
+INFLUXDATAGRAM = 1400
+
+
+def exporting():
+    """Return True if the channels go to other consumers too"""
+    return bool(PROMFILE or PROMPORT or INFLUX)
+
+
+def keep_samples(host, checked):
+    """Add the channels of one appliance to the sample set"""
+    SAMPLES.extend([Sample(host, name, value, UNITS.get(template, "Custom"))
+                    for name, value, template in checked.channels])
+
+
+def prometheus_label(value):
+    """Return value escaped for a prometheus label"""
+    return (value.replace("\\", "\\\\").replace("\"", "\\\"")
+            .replace("\n", "\\n"))
+
+
+def prometheus_text(samples):
+    """Return samples in prometheus text exposition format, one gauge with
+    the host, channel and unit as labels."""
+    lines = ["# HELP {} Value of a ZFSSA sensor channel".format(PROMMETRIC),
+             "# TYPE {} gauge".format(PROMMETRIC)]
+    lines.extend(['{}{{host="{}",channel="{}",unit="{}"}} {}'.format(
+        PROMMETRIC, prometheus_label(sample.host),
+        prometheus_label(sample.channel), prometheus_label(sample.unit),
+        sample.value) for sample in samples])
+    return "\n".join(lines) + "\n"
+
+
+def influx_tag(value):
+    """Return value escaped for an influx line protocol tag"""
+    return re.sub(r"([,= ])", r"\\\1", value)
+
+
+def influx_lines(samples, started):
+    """Return samples in influx line protocol, timestamped at started"""
+    timestamp = int(started * 1000000000)
+    lines = []
+    for sample in samples:
+        value = sample.value
+        if type(value) is int:
+            value = "{}i".format(value)
+        lines.append("{},host={},channel={},unit={} value={} {}".format(
+            INFLUXMEASUREMENT, influx_tag(sample.host),
+            influx_tag(sample.channel), influx_tag(sample.unit), value,
+            timestamp))
+    return lines
+
+
+def send_influx(lines):
+    """Send line protocol lines to INFLUX: udp://<host>:<port> for an influx
+    udp listener, else a file they are appended to."""
+    if INFLUX.startswith("udp://"):
+        import socket
+        host, port = INFLUX[len("udp://"):].rsplit(":", 1)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        batch = []
+        size = 0
+        for line in lines:
+            if batch and size + len(line) > INFLUXDATAGRAM:
+                sock.sendto("\n".join(batch).encode(), (host, int(port)))
+                batch, size = [], 0
+            batch.append(line)
+            size += len(line) + 1
+        if batch:
+            sock.sendto("\n".join(batch).encode(), (host, int(port)))
+        sock.close()
+    else:
+        with open(INFLUX, "a") as stream:
+            stream.write("\n".join(lines) + "\n")
+
+
+def export(started):
+    """Give the sample set of the collection started at started to the
+    prometheus file, the --listen endpoint and influx. Failures don't change
+    the PRTG result."""
+    try:
+        if PROMFILE or PROMPORT:
+            text = prometheus_text(SAMPLES)
+            EXPOSITION[0] = text
+        if PROMFILE:
+            # replaced in one step, a scraper never reads it half written
+            tmp = "{}.{}".format(PROMFILE, os.getpid())
+            with open(tmp, "w") as prom:
+                prom.write(text)
+            os.replace(tmp, PROMFILE)
+        if INFLUX and SAMPLES:
+            send_influx(influx_lines(SAMPLES, started))
+    except Exception:
+        pass
+
+
+def start_exporter(port):
+    """Serve the prometheus text of the last collection on port, from a
+    background thread of the daemon."""
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+    class ExporterHandler(BaseHTTPRequestHandler):
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            body = EXPOSITION[0].encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type",
+                             "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = HTTPServer(("", port), ExporterHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def run_checks(checks, deadline):
+    """Run checks in the given order on every appliance. The dataset requests
+    are sent in parallel first, with at most WORKERS in flight per appliance
+    so a slow one doesn't hold the others, then the checks only wait for
+    them. Channels keep the same order as in a serial run, grouped by
+    appliance.
+
+    Every request uses the time left until deadline as its timeout. Checks
+    still waiting when the deadline comes fail, so the channels already
+    retrieved are always returned. Datasets the appliance doesn't have are
+    not requested again until MISSINGTTL expires, their checks are reported
+    as not available. Datasets with a refresh tier are only requested when
+    their cached sample is older than it.
+
+    With --discover the checks are the ones for the active datasets of the
+    appliances instead, each appliance only gets its own datasets."""
+    global DEADLINE, APPLIANCE, channels
+    DEADLINE = deadline
+    workers = max(1, min(WORKERS, len(checks)))
+    del SAMPLES[:]
+    for appliance in APPLIANCES:
+        appliance.stats = {}
+        if appliance.peer is not None:
+            appliance.peer.stats = {}
+    closed = [a for a in APPLIANCES if a.session is None]
+    if closed:
+        from concurrent.futures import ThreadPoolExecutor
+        pool = ThreadPoolExecutor(max_workers=len(closed))
+        list(pool.map(lambda a: a.open_session(workers), closed))
+        pool.shutdown()
+    if DISCOVER:
+        checks = discover_checks()
+        workers = max(1, min(WORKERS, len(checks)))
+    ttls = dict((RESOURCES[c], REFRESH[c]) for c in checks if REFRESH.get(c))
+    for appliance in APPLIANCES:
+        appliance.reuse_samples(ttls)
+        if REPLAYFILE:
+            # requests are made by the checks, in the thread profiled
+            continue
+        appliance.prefetch([c for c in checks
+                            if appliance.listed(RESOURCES[c]) and
+                            appliance.available(RESOURCES[c])], workers)
+    result = channels
+    for appliance in APPLIANCES:
+        APPLIANCE = appliance
+        channels = SensorResult()
+        missing = []
+        for check in checks:
+            if not appliance.listed(RESOURCES[check]):
+                continue
+            if appliance.available(RESOURCES[check]):
+                check_function(check)()
+            else:
+                missing.append(check)
+        if missing:
+            message = "| not available: {} |".format(", ".join(missing))
+            if channels.sensor_message == "OK":
+                channels.sensor_message = message
+            else:
+                channels.sensor_message += message
+        if CAPACITY:
+            add_capacity_channels()
+        appliance.save_missing()
+        appliance.save_samples()
+        appliance.save_latency()
+        if SELFMETRICS:
+            add_self_channels(appliance, checks)
+        label = appliance_label(appliance)
+        if exporting():
+            keep_samples(label, channels)
+        merge_result(result, label, channels)
+        # requests not sent yet for checks that failed before them
+        for future in appliance.prefetched.values():
+            future.cancel()
+        appliance.prefetched.clear()
+    channels = result
 
 
 ###############################################################################
 # MAIN Function
 ###############################################################################
+def selected_checks():
+    """Return the checks to run from the include and exclude parameters.
+    capacity is not a dataset check, including it runs the capacity
+    collector."""
+    if INCLUDECHECKS:
+        return [check for check in INCLUDECHECKS if check != "capacity"]
+    for check in EXCLUDECHECKS:
+        ENABLEDCHECKS.pop(check, None)
+    return list(ENABLEDCHECKS)
+
+
+def unknown_checks():
+    """Return the include, exclude and refresh parameters that are not check
+    names. capacity has no refresh tier, its index has its own walk age.
+    With --discover they can be dataset names too, so none is unknown."""
+    if DISCOVER:
+        return []
+    known = set(ENABLEDCHECKS).union(BREAKDOWNCHECKS, LATENCYCHECKS)
+    return ([check for check in INCLUDECHECKS + EXCLUDECHECKS
+             if check not in known and check != "capacity"] +
+            [check for check in REFRESH if check not in known])
+
+
+def collect(checks, started, deadline):
+    """Run checks on a new result and return it in PRTG json format"""
+    global channels
+    trim_templates()
+    channels = SensorResult()
+    run_checks(checks, deadline)
+    if SELFMETRICS and channels.channels:
+        channels.add_channel(channel_name="Collector Run Time",
+                             value=int((time.time() - started) * 1000),
+                             unit="TimeResponse")
+    if TRACEFILE:
+        write_trace(started)
+    if exporting():
+        export(started)
+    if not channels.channels:
+        channels.add_error("No channels can be retrieved")
+    return channels.get_json_result()
+
+
+def daemon(checks):
+    """Collect checks every DAEMONINTERVAL seconds and keep the last result in
+    the result cache, for sensors started with --cached. With --listen the
+    last collection is served to prometheus too."""
+    if PROMPORT:
+        start_exporter(PROMPORT)
+    while True:
+        started = time.time()
+        deadline = started + min(PRTGTIMEOUT, DAEMONINTERVAL)
+        try:
+            result = collect(checks, started, deadline)
+            write_cache(result_name(), "result",
+                        {"time": started, "result": json.loads(result)})
+        except Exception:
+            # keep polling, sensors see the cached result getting old
+            pass
+        time.sleep(max(0, started + DAEMONINTERVAL - time.time()))
+
+
+def replay(checks):
+    """Collect checks from the responses of REPLAYFILE, with a new cache
+    directory and no coalescing or rate limit so every replay does the same
+    work. The record has the responses of every dataset of the recorded
+    run, as --record ignores the cached state. The collection is profiled,
+    the functions taking the most time are printed to stderr and the whole
+    profile saved to PROFILEFILE."""
+    global CACHEDIR, COALESCETTL, RATELIMIT
+    import shutil
+    import pstats
+    import cProfile
+    import tempfile
+    try:
+        load_record(REPLAYFILE)
+    except (IOError, ValueError) as error:
+        channels.add_error("Can't read record file {}: {}".format(
+            REPLAYFILE, error))
+        return channels.get_json_result()
+    CACHEDIR = tempfile.mkdtemp()
+    COALESCETTL = RATELIMIT = 0
+    profile = cProfile.Profile()
+    started = time.time()
+    profile.enable()
+    try:
+        result = collect(checks, started,
+                         started + PRTGTIMEOUT - DEADLINEMARGIN)
+    finally:
+        profile.disable()
+        shutil.rmtree(CACHEDIR)
+    stats = pstats.Stats(profile, stream=sys.stderr)
+    stats.sort_stats("cumulative").print_stats(REPLAYTOP)
+    if PROFILEFILE:
+        stats.dump_stats(PROFILEFILE)
+    return result
+
+
+def cached_result():
+    """Return the result cached by the daemon in PRTG json format, with the
+    age of the data as a channel. Data older than CACHEDMAXAGE is an error."""
+    cached = read_cache(result_name(), "result")
+    if cached is None:
+        channels.add_error("No cached result, is the daemon running with "
+                           "the same options?")
+        return channels.get_json_result()
+    age = int(time.time() - cached["time"])
+    if age > CACHEDMAXAGE:
+        channels.add_error("Cached result is {} seconds old".format(age))
+        return channels.get_json_result()
+    result = cached["result"]
+    if "result" in result["prtg"]:
+        result["prtg"]["result"].append({"name": "Data Age",
+                                         "value": age,
+                                         "unit": "TimeSeconds"})
+    return json.dumps(result)
+
+
 def main():
-    global TIMEOUT
-    if INCLUDECHECKS and EXCLUDECHECKS:
+    global APPLIANCES
+    parse_params(sys.argv[1:])
+    if INVENTORY:
+        APPLIANCES = read_inventory(INVENTORY)
+    APPLIANCES += [Appliance(host) for host in HOSTS]
+    if CACHEDMAXAGE:
+        print(cached_result())
+    elif INCLUDECHECKS and EXCLUDECHECKS:
         channels.add_error("Sensor failed: can't use include and exclude")
-    elif INCLUDECHECKS:
-        TIMEOUT = int(PRTGTIMEOUT / len(INCLUDECHECKS))
-        for check in INCLUDECHECKS:
-            ENABLEDCHECKS[check]()
-    elif EXCLUDECHECKS:
-        for check in EXCLUDECHECKS:
-            del ENABLEDCHECKS[check]
-        TIMEOUT = int(PRTGTIMEOUT / len(ENABLEDCHECKS))
-        for check in ENABLEDCHECKS:
-            ENABLEDCHECKS[check]()
+        print(channels.get_json_result())
+    elif BADREFRESH:
+        channels.add_error("Sensor failed: refresh tiers must be "
+                           "<check>=<tier>, not {}".format(
+                               ",".join(BADREFRESH)))
+        print(channels.get_json_result())
+    elif unknown_checks():
+        channels.add_error("Sensor failed: unknown checks {}".format(
+            ",".join(unknown_checks())))
+        print(channels.get_json_result())
+    elif REPLAYFILE:
+        print(replay([] if DISCOVER else selected_checks()))
+    elif DAEMONINTERVAL:
+        # with --discover checks are chosen from the datasets found in
+        # every run
+        daemon([] if DISCOVER else selected_checks())
     else:
-        TIMEOUT = int(PRTGTIMEOUT / len(ENABLEDCHECKS))
-        for check in ENABLEDCHECKS:
-            ENABLEDCHECKS[check]()
-    if not channels.channels:
-        channels.add_error("No channels can be retrieved")
-    print(channels.get_json_result())
+        print(collect([] if DISCOVER else selected_checks(), STARTED,
+                      STARTED + PRTGTIMEOUT - DEADLINEMARGIN))
+        sys.stdout.flush()
+        if threading.active_count() > 1:
+            # don't wait for requests still running after the deadline
+            os._exit(0)
 
 
 if __name__ == "__main__":